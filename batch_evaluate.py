@@ -0,0 +1,139 @@
+import os
+import csv
+import json
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from coco_evaluator import load_ground_truth, load_predictions, evaluate_predictions
+from sahi_logs import parse_slice_config, parse_sahi_log, latency_stats
+
+# evaluate every runs/<run>/sahi/<size>_<overlap>/result.json against the same ground truth and put the results in
+# one table (one row per run and sahi config) instead of notebook cells and hand typed numbers in results.xlsx.
+# metrics are cached by the hash of the result file, so only new or changed predictions are evaluated again.
+# the latency of the same sahi run (parsed from the output.txt next to result.json) goes in the same row
+
+METRIC_FIELDS = ['bbox_mAP', 'bbox_mAP50', 'bbox_mAP75', 'bbox_mAP_s', 'bbox_mAP_m', 'bbox_mAP_l',
+                 'bbox_mAP50_s', 'bbox_mAP50_m', 'bbox_mAP50_l']
+OPTIMIZERS = {'auto': 'auto', 'sgd': 'SGD', 'adam': 'Adam', 'adamw': 'AdamW', 'rmsprop': 'RMSProp'}
+
+def parse_run_name(name):
+    # run folders look like 100e_16b_auto or yolov8n_100e_0p_16b_AdamW_320_30 (model, epochs, patience,
+    # batch, optimizer, train slice size and overlap), missing parts are None
+    config = {'model': None, 'epochs': None, 'patience': None, 'batch': None, 'optimizer': None,
+              'train_slice_size': None, 'train_overlap': None}
+    numbers = []
+    for part in name.split('_'):
+        lower = part.lower()
+        if lower.startswith('yolo'):
+            config['model'] = lower
+        elif lower.endswith('e') and lower[:-1].isdigit():
+            config['epochs'] = int(lower[:-1])
+        elif lower.endswith('p') and lower[:-1].isdigit():
+            config['patience'] = int(lower[:-1])
+        elif lower.endswith('b') and lower[:-1].isdigit():
+            config['batch'] = int(lower[:-1])
+        elif lower in OPTIMIZERS:
+            config['optimizer'] = OPTIMIZERS[lower]
+        elif lower.isdigit():
+            numbers.append(part)
+    if len(numbers) == 2:
+        config['train_slice_size'], config['train_overlap'] = parse_slice_config('_'.join(numbers))
+    return config
+
+def find_results(runs_dir = 'runs'):
+    return sorted(glob.glob(os.path.join(runs_dir, '*', 'sahi', '*', 'result.json')))
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ground_truth_hash(gt_source):
+    # a columnar store is meta.json and every column file it lists, a rewritten column changes the hash as well
+    if os.path.isfile(gt_source):
+        return file_hash(gt_source)
+    meta_path = os.path.join(gt_source, 'meta.json')
+    with open(meta_path) as file:
+        meta = json.load(file)
+    paths = [meta_path] + [os.path.join(gt_source, f'{key}.{column}.npy')
+                           for key, columns in meta['columns'].items() for column in columns]
+    return hashlib.sha1(' '.join(file_hash(path) for path in paths).encode('utf-8')).hexdigest()
+
+# the ground truth is loaded once in the main process and handed to every worker when it starts
+worker_ground_truth = None
+
+def init_worker(ground_truth):
+    global worker_ground_truth
+    worker_ground_truth = ground_truth
+
+def evaluate_result(result_path):
+    return evaluate_predictions(worker_ground_truth, load_predictions(result_path))
+
+def flatten_metrics(metrics):
+    row = {field: metrics[field] for field in METRIC_FIELDS}
+    for threshold, counts in metrics['counts'].items():
+        for key, value in counts.items():
+            row[f'{key}@{threshold}'] = value
+    return row
+
+def config_row(result_path):
+    config_dir = os.path.dirname(result_path)
+    run = os.path.basename(os.path.dirname(os.path.dirname(config_dir)))
+    slice_size, overlap = parse_slice_config(os.path.basename(config_dir))
+    return {'run': run, **parse_run_name(run), 'slice_size': slice_size, 'overlap': overlap}
+
+LATENCY_FIELDS = ['slices_per_image', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'slices_per_s', 'warm_p50_ms', 'warm_p95_ms',
+                  'warm_p99_ms', 'warm_mean_ms', 'warm_slices_per_s', 'outliers']
+
+def latency_row(result_path):
+    log_path = os.path.join(os.path.dirname(result_path), 'output.txt')
+    stats = latency_stats(*parse_sahi_log(log_path)) if os.path.exists(log_path) else {'images': 0}
+    return {field: stats.get(field) for field in LATENCY_FIELDS}
+
+def write_table(rows, output_path):
+    fields = []
+    for row in rows:
+        fields.extend(field for field in row if field not in fields)
+    with open(output_path, 'w', newline = '') as file:
+        writer = csv.DictWriter(file, fieldnames = fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def batch_evaluate(gt_source, runs_dir = 'runs', output_path = 'results.csv', cache_path = 'eval_cache.json', workers = 4):
+    result_paths = find_results(runs_dir)
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cache = json.load(file)
+
+    # the ground truth is part of the key, a new gt json or store invalidates everything
+    gt_hash = ground_truth_hash(gt_source)
+    keys = {path: f'{gt_hash}:{file_hash(path)}' for path in result_paths}
+    todo = [path for path in result_paths if keys[path] not in cache]
+    print(f'{len(result_paths)} result files, {len(result_paths) - len(todo)} cached, evaluating {len(todo)}.')
+
+    if todo:
+        ground_truth = load_ground_truth(gt_source)
+        if workers <= 1:
+            init_worker(ground_truth)
+            metrics = [evaluate_result(path) for path in todo]
+        else:
+            with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (ground_truth,)) as executor:
+                metrics = list(executor.map(evaluate_result, todo))
+        for path, result in zip(todo, metrics):
+            cache[keys[path]] = result
+
+        with open(cache_path, 'w') as file:
+            json.dump(cache, file)
+
+    rows = [{**config_row(path), **flatten_metrics(cache[keys[path]]), **latency_row(path), 'result_path': path} for path in result_paths]
+    write_table(rows, output_path)
+    print(f'Wrote {len(rows)} rows to "{output_path}".')
+    return rows
+
+if __name__ == '__main__':
+    batch_evaluate('../heridal/testImages/coco_test_label.json', workers = os.cpu_count())
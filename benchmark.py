@@ -0,0 +1,267 @@
+import os
+import io
+import json
+import time
+import glob
+import random
+import tempfile
+import tracemalloc
+import contextlib
+
+import numpy as np
+
+from voc2coco import voc2coco
+from coco_writer import write_coco
+from coco_columnar import save_columnar, load_columnar
+from prediction_merge import match_scores, merge_predictions
+from prediction_store import json_to_store, load_predictions_store, image_predictions, store_to_results
+from tile_shards import pack_dataset, open_shards, close_shards, read_tile, iter_tiles
+from synthetic_dataset import make_voc_dataset
+
+def time_call(function, *args, **kwargs):
+    # silence the per-file prints so they don't dominate the timing
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def bench_voc2coco_workers(n_files = 5000, workers_list = (1, 2, 4, 8)):
+    print(f'\n>>> voc2coco parsing {n_files} xml files\n')
+    with tempfile.TemporaryDirectory() as root:
+        label_dir = make_voc_dataset(root, n_files)
+        categories = [{"supercategory": "none", "id": 0, "name": "human"}]
+
+        baseline = None
+        expected = None
+        for workers in workers_list:
+            output = os.path.join(root, f'coco_{workers}.json')
+            elapsed = time_call(voc2coco, ann_dir = label_dir, img_dir = root, img_file_prefix = 'train_',
+                                img_file_extension = '.JPG', output_filename = output, categories = categories,
+                                workers = workers)
+            with open(output) as file:
+                result = json.load(file)
+
+            # parallel output must be identical to the serial one
+            if expected is None:
+                baseline = elapsed
+                expected = result
+            assert result == expected, f'output with {workers} workers differs from serial output'
+
+            print(f'workers: {workers:2d}  time: {elapsed:7.3f}s  speedup: {baseline / elapsed:5.2f}x')
+
+def make_coco(n_images = 20000, annotations_per_image = 15, seed = 0):
+    # roughly the shape of a sliced dataset json
+    rng = random.Random(seed)
+    images = []
+    annotations = []
+    for image_id in range(1, n_images + 1):
+        images.append({'file_name': f'train_SYN_{image_id:06d}_0_0_320_320.jpg', 'height': 320, 'width': 320, 'id': image_id})
+        for _ in range(annotations_per_image):
+            x, y, w, h = rng.randint(0, 300), rng.randint(0, 300), rng.randint(10, 60), rng.randint(10, 60)
+            annotations.append({'area': w * h, 'iscrowd': 0, 'bbox': [x, y, w, h], 'category_id': 0,
+                                'ignore': 0, 'image_id': image_id, 'id': len(annotations) + 1})
+    return {'images': images, 'annotations': annotations, 'categories': [{"supercategory": "none", "id": 0, "name": "human"}]}
+
+def measure(function, *args, **kwargs):
+    # wall-clock time of a plain call, then peak python memory of a second traced call (tracing skews the timing)
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def dumps_and_write(filename, coco):
+    # the old path of voc2coco and remove_unused_images
+    json_object = json.dumps(coco, indent=4)
+    with open(filename, "w") as outfile:
+        outfile.write(json_object)
+
+def bench_coco_writer(n_images = 10000, annotations_per_image = 15):
+    coco = make_coco(n_images, annotations_per_image)
+    print(f'\n>>> writing coco json with {len(coco["images"])} images and {len(coco["annotations"])} annotations\n')
+    with tempfile.TemporaryDirectory() as root:
+        output = os.path.join(root, 'coco.json')
+        for name, function, kwargs in [('json.dumps indent=4', dumps_and_write, {}),
+                                       ('write_coco indent=4', write_coco, {}),
+                                       ('write_coco compact', write_coco, {'compact': True})]:
+            elapsed, peak = measure(function, output, coco, **kwargs)
+            print(f'{name:20s}  time: {elapsed:7.3f}s  peak memory: {peak / 2**20:8.1f} MiB  file size: {os.path.getsize(output) / 2**20:8.1f} MiB')
+
+def bench_columnar_load(n_images = 10000, annotations_per_image = 15):
+    coco = make_coco(n_images, annotations_per_image)
+    print(f'\n>>> loading {len(coco["annotations"])} annotations and summing the box areas\n')
+    with tempfile.TemporaryDirectory() as root:
+        json_path = os.path.join(root, 'coco.json')
+        store_path = os.path.join(root, 'coco_columnar')
+        write_coco(json_path, coco)
+        save_columnar(store_path, coco)
+
+        def from_json():
+            with open(json_path) as file:
+                data = json.load(file)
+            return sum(annotation['bbox'][2] * annotation['bbox'][3] for annotation in data['annotations'])
+
+        def from_columnar():
+            bbox = load_columnar(store_path)['annotations']['bbox']
+            return int((bbox[:, 2] * bbox[:, 3]).sum())
+
+        assert from_json() == from_columnar()
+        for name, function in [('json.load', from_json), ('load_columnar (mmap)', from_columnar)]:
+            elapsed, peak = measure(function)
+            print(f'{name:20s}  time: {elapsed:7.3f}s  peak memory: {peak / 2**20:8.1f} MiB')
+
+def naive_greedy_nmm(boxes, scores, categories, threshold = 0.5, metric = 'IOS'):
+    # pairwise greedy nmm: every kept box is compared with every remaining box of its category
+    merged = []
+    for category in np.unique(categories):
+        group = np.flatnonzero(categories == category)
+        remaining = list(group[np.argsort(-scores[group], kind = 'stable')])
+        while remaining:
+            keep = remaining.pop(0)
+            box = boxes[keep].copy()
+            others = []
+            for index in remaining:
+                if match_scores(boxes[keep], boxes[index], metric) >= threshold:
+                    others.append(index)
+            for index in others:
+                remaining.remove(index)
+                if match_scores(box, boxes[index], metric) > threshold:
+                    box[:2] = np.minimum(box[:2], boxes[index, :2])
+                    box[2:] = np.maximum(box[2:], boxes[index, 2:])
+            merged.append((keep, box))
+    return merged
+
+def slice_duplicates(result_path, copies = 4, seed = 0):
+    # result.json boxes are already merged, jitter a few copies of each to look like raw per-slice predictions
+    rng = np.random.default_rng(seed)
+    with open(result_path) as file:
+        results = json.load(file)
+    by_image = {}
+    for result in results:
+        by_image.setdefault(result['image_id'], []).append(result['bbox'] + [result['score']])
+
+    images = []
+    for rows in by_image.values():
+        rows = np.array(rows)
+        boxes = np.concatenate([rows[:, :2], rows[:, :2] + rows[:, 2:4]], axis = 1)
+        sizes = np.tile(rows[:, 2:4], 2)
+        boxes = np.concatenate([boxes] + [boxes + rng.normal(0, 0.05, boxes.shape) * sizes for _ in range(copies)])
+        scores = np.concatenate([rows[:, 4]] + [rows[:, 4] * rng.uniform(0.8, 1.0, len(rows)) for _ in range(copies)])
+        images.append((boxes, scores, np.zeros(len(boxes), dtype = np.int64)))
+    return images
+
+def bench_prediction_merge(result_paths = None, copies = 4):
+    if result_paths is None:
+        result_paths = sorted(glob.glob(os.path.join('runs', '*', 'sahi', '320_30', 'result.json')))
+    print(f'\n>>> greedy nmm on {len(result_paths)} result files with {copies} jittered copies of every box\n')
+    for result_path in result_paths:
+        images = slice_duplicates(result_path, copies)
+        n_boxes = sum(len(boxes) for boxes, _, _ in images)
+
+        start = time.perf_counter()
+        naive = [naive_greedy_nmm(*image) for image in images]
+        naive_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        grid = [merge_predictions(*image) for image in images]
+        grid_time = time.perf_counter() - start
+
+        # both have to keep the same boxes
+        for naive_image, (grid_boxes, _, _) in zip(naive, grid):
+            naive_boxes = np.array([box for _, box in naive_image]).reshape(-1, 4)
+            assert np.allclose(naive_boxes[np.lexsort(naive_boxes.T)], grid_boxes[np.lexsort(grid_boxes.T)])
+
+        print(f'{result_path}: {n_boxes} boxes  pairwise: {naive_time:6.2f}s  grid: {grid_time:6.2f}s  speedup: {naive_time / grid_time:5.1f}x')
+
+def bench_prediction_store(result_paths = None):
+    if result_paths is None:
+        result_paths = sorted(glob.glob(os.path.join('runs', '*', 'sahi', '*', 'result.json')))
+    print(f'\n>>> {len(result_paths)} result files as json and as prediction stores, reading the boxes of one image\n')
+    json_bytes = store_bytes = 0
+    json_time = store_time = 0.0
+    with tempfile.TemporaryDirectory() as root:
+        for index, result_path in enumerate(result_paths):
+            store_path = os.path.join(root, str(index))
+            json_to_store(result_path, store_path)
+            store = load_predictions_store(store_path)
+            with open(result_path) as file:
+                assert store_to_results(store) == json.load(file)
+            json_bytes += os.path.getsize(result_path)
+            store_bytes += sum(entry.stat().st_size for entry in os.scandir(store_path))
+            image_id = int(store['image_ids'][len(store['image_ids']) // 2]) if len(store['image_ids']) else 0
+
+            start = time.perf_counter()
+            with open(result_path) as file:
+                [result['bbox'] for result in json.load(file) if result['image_id'] == image_id]
+            json_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            image_predictions(load_predictions_store(store_path), image_id)
+            store_time += time.perf_counter() - start
+
+    print(f'json   size: {json_bytes / 2**20:7.2f} MiB  one image: {json_time / len(result_paths) * 1000:7.2f} ms')
+    print(f'store  size: {store_bytes / 2**20:7.2f} MiB  one image: {store_time / len(result_paths) * 1000:7.2f} ms')
+
+def make_tile_dataset(root, n_tiles = 3000, tile_size = 320, seed = 0):
+    # small jpg tiles with a few boxes each, like a sliced training set
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, 'images'), exist_ok = True)
+    base = rng.integers(0, 255, (tile_size, tile_size, 3), dtype = np.uint8)
+    images, annotations = [], []
+    for image_id in range(1, n_tiles + 1):
+        file_name = f'tile_{image_id:06d}.jpg'
+        Image.fromarray(np.roll(base, image_id, axis = 1)).save(os.path.join(root, 'images', file_name), quality = 90)
+        images.append({'id': image_id, 'file_name': file_name, 'height': tile_size, 'width': tile_size})
+        for _ in range(int(rng.integers(1, 4))):
+            x, y = rng.uniform(0, tile_size - 40, 2).round(1).tolist()
+            annotations.append({'id': len(annotations) + 1, 'image_id': image_id, 'category_id': 0,
+                                'bbox': [x, y, 30.0, 30.0], 'area': 900.0, 'iscrowd': 0})
+    coco = {'images': images, 'annotations': annotations, 'categories': [{'id': 0, 'name': 'human'}]}
+    write_coco(os.path.join(root, 'coco.json'), coco)
+    return coco
+
+def bench_tile_shards(n_tiles = 3000):
+    print(f'\n>>> reading {n_tiles} jpg tiles as loose files and from shards (page cache warm)\n')
+    with tempfile.TemporaryDirectory() as root:
+        coco = make_tile_dataset(root, n_tiles)
+        with contextlib.redirect_stdout(io.StringIO()):
+            pack_dataset(os.path.join(root, 'coco.json'), os.path.join(root, 'images'), os.path.join(root, 'shards'), shard_size = 32 * 2**20)
+        file_names = [image['file_name'] for image in coco['images']]
+        shuffled = np.random.default_rng(0).permutation(len(file_names)).tolist()
+
+        def loose(order):
+            total = 0
+            for position in order:
+                with open(os.path.join(root, 'images', file_names[position]), 'rb') as file:
+                    total += len(file.read())
+            return total
+
+        def shards_random(order):
+            store = open_shards(os.path.join(root, 'shards'))
+            total = sum(len(read_tile(store, position)[0]) for position in order)
+            close_shards(store)
+            return total
+
+        def shards_sequential(_):
+            return sum(len(tile[1]) for tile in iter_tiles(os.path.join(root, 'shards')))
+
+        for name, function, order in [('loose files, in order', loose, range(n_tiles)), ('loose files, shuffled', loose, shuffled),
+                                      ('shards, random access', shards_random, shuffled), ('shards, streaming', shards_sequential, None)]:
+            start = time.perf_counter()
+            total = function(order)
+            elapsed = time.perf_counter() - start
+            print(f'{name:24s}  {n_tiles / elapsed:9.0f} tiles/s  {total / elapsed / 2**20:8.1f} MiB/s')
+
+if __name__ == '__main__':
+    bench_voc2coco_workers()
+    bench_coco_writer()
+    bench_columnar_load()
+    bench_prediction_merge()
+    bench_prediction_store()
+    bench_tile_shards()
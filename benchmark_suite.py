@@ -0,0 +1,120 @@
+import io
+import os
+import json
+import time
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from voc2coco import voc2coco
+from cleanup import remove_unused_images
+from optimal_overlap_calcu import optimize_overlap_sweep
+from coco_evaluator import evaluate
+from run_metrics import peak_memory
+from synthetic_dataset import CATEGORIES, make_heridal_dataset
+
+# times the dataset tools on the synthetic heridal (synthetic_dataset) at 1x, 10x and 100x its size and compares
+# them with the baselines stored in benchmark_baselines.json. every tool runs in a fresh process, so the peak
+# memory is that tool's alone and nothing is warm from the tool before.
+# the baselines only mean something on the machine they were recorded on, record them again after moving.
+# the datasets are generated in a child process too: linux keeps ru_maxrss over fork and exec, so a child's peak
+# can never be lower than its parent's and the suite process has to stay small
+
+SCALES = (1, 10, 100)
+BASELINE_PATH = 'benchmark_baselines.json'
+TOLERANCE = 1.25
+
+def measured(function, kwargs):
+    # runs in the fresh process: return value, seconds and peak rss of one call, the tools' prints are dropped
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        value = function(**kwargs)
+    return value, time.perf_counter() - start, peak_memory()[0]
+
+def run_isolated(function, **kwargs):
+    # spawn (not fork) so the child does not get a copy of this process' memory
+    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(measured, function, kwargs).result()
+
+def suite_tasks(dataset, root, workers):
+    # (name, function, kwargs), in this order because remove_unused_images deletes the images voc2coco did not use
+    train_json = os.path.join(root, 'coco_train_label.json')
+    return [
+        ('voc2coco', voc2coco, {'ann_dir': dataset['train_labels'], 'img_dir': dataset['train_dir'], 'img_file_prefix': 'train_',
+                                'img_file_extension': '.JPG', 'output_filename': train_json, 'categories': CATEGORIES,
+                                'verbose': False}),
+        (f'voc2coco_{workers}_workers', voc2coco, {'ann_dir': dataset['train_labels'], 'img_dir': dataset['train_dir'],
+                                                   'img_file_prefix': 'train_', 'img_file_extension': '.JPG',
+                                                   'output_filename': train_json, 'categories': CATEGORIES,
+                                                   'workers': workers, 'verbose': False}),
+        ('optimize_overlap', optimize_overlap_sweep, {'source': dataset['train_labels'], 'workers': 1}),
+        ('evaluate', evaluate, {'gt_source': dataset['gt_path'], 'result_path': dataset['result_paths'][0]}),
+        ('evaluate_stream', evaluate, {'gt_source': dataset['gt_path'], 'result_path': dataset['result_paths'][0], 'stream': True}),
+        ('remove_unused_images', remove_unused_images, {'image_path': dataset['train_dir'], 'json_path': train_json,
+                                                        'extensions': ('.JPG',)})
+    ]
+
+def load_baselines(baseline_path):
+    if not os.path.exists(baseline_path):
+        return {'machine': None, 'scales': {}}
+    with open(baseline_path) as file:
+        return json.load(file)
+
+def machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version()}
+
+def compare(result, baseline, tolerance = TOLERANCE):
+    # '' when within tolerance of the baseline, otherwise what got worse
+    if baseline is None:
+        return 'no baseline'
+    flags = []
+    if result['seconds'] > baseline['seconds'] * tolerance:
+        flags.append(f'{result["seconds"] / baseline["seconds"]:.2f}x slower')
+    if result['peak_rss_bytes'] and baseline['peak_rss_bytes'] and result['peak_rss_bytes'] > baseline['peak_rss_bytes'] * tolerance:
+        flags.append(f'{result["peak_rss_bytes"] / baseline["peak_rss_bytes"]:.2f}x memory')
+    return ', '.join(flags)
+
+def run_suite(scales = SCALES, baseline_path = BASELINE_PATH, update_baseline = False, tolerance = TOLERANCE,
+              workers = 4, keep_dir = None):
+    # returns {scale: {task: result}}, with update_baseline the results become the new baselines.
+    # keep_dir keeps the generated datasets there instead of a temporary folder
+    baselines = load_baselines(baseline_path)
+    if baselines['machine'] is not None and baselines['machine'] != machine_info():
+        print(f'Baselines in "{baseline_path}" were recorded on another machine ({baselines["machine"]["platform"]}).')
+
+    results = {}
+    regressions = []
+    for scale in scales:
+        folder = tempfile.TemporaryDirectory() if keep_dir is None else contextlib.nullcontext(os.path.join(keep_dir, f'{scale}x'))
+        with folder as root:
+            dataset, seconds, _ = run_isolated(make_heridal_dataset, root = root, scale = scale)
+            print(f'\n>>> {scale}x heridal: {dataset["train_files"]} train and {dataset["test_files"]} test label files '
+                  f'(generated in {seconds:.1f}s)\n')
+
+            results[str(scale)] = {}
+            for name, function, kwargs in suite_tasks(dataset, root, workers):
+                _, seconds, peak = run_isolated(function, **kwargs)
+                result = {'seconds': seconds, 'peak_rss_bytes': peak, 'files': dataset['train_files'] + dataset['test_files']}
+                results[str(scale)][name] = result
+                flag = compare(result, baselines['scales'].get(str(scale), {}).get(name), tolerance)
+                if flag and flag != 'no baseline':
+                    regressions.append((scale, name, flag))
+                peak_text = f'{peak / 2**20:8.1f} MiB' if peak is not None else f'{"-":>8} MiB'
+                print(f'{name:24s}  time: {seconds:8.3f}s  peak memory: {peak_text}  {flag}')
+
+    if update_baseline:
+        baselines['machine'] = machine_info()
+        baselines['scales'].update(results)
+        with open(baseline_path, 'w') as file:
+            json.dump(baselines, file, indent = 4)
+        print(f'\nBaselines written to "{baseline_path}".')
+    elif regressions:
+        print(f'\n{len(regressions)} results more than {tolerance:g}x over the baseline.')
+    return results
+
+# guarded so the spawned processes can import this module without running the suite
+if __name__ == '__main__':
+    run_suite(update_baseline = not os.path.exists(BASELINE_PATH))
@@ -1,38 +1,86 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+from coco_writer import write_coco
+from run_metrics import measured_run, stage, count, finish_metrics
 
 # remove unused slices
 
+def find_unused_images(image_path, used_images, extensions = ('.jpg',)):
+    # single scandir pass, matching the extension case-insensitively (.JPG, .jpg, .Jpg, ...).
+    # a single extension can be given as a string, a tuple of its characters would match almost every file
+    if isinstance(extensions, str):
+        extensions = (extensions,)
+    extensions = tuple(extension.lower() for extension in extensions)
+    unused = []
+    found = set()
+    with os.scandir(image_path) as entries:
+        for entry in entries:
+            if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                continue
+
+            if entry.name in used_images:
+                found.add(entry.name)
+            else:
+                unused.append((entry.name, entry.stat().st_size))
+    return unused, found
+
 def remove_unused_images(image_path = os.getcwd(),
-                         json_path = os.getcwd()):
-    images = os.listdir(image_path)
-    coco = json.load(open(json_path))
-    coco_images = coco['images']
-    used_images = []
-
-    for image in coco_images:
-        used_images.append(image['file_name'])
-
-    # remove unused images
-    for image in images:
-        if not (image.endswith('.JPG') or image.endswith('.jpg')):
-            continue
-
-        if image not in used_images:
-            os.remove(os.path.join(image_path, image))
-        else:
-            used_images.pop(used_images.index(image))
-    
-    for annotation in coco['annotations']:
-        if 'segmentation' in annotation:
-            annotation.pop('segmentation')
+                         json_path = os.getcwd(),
+                         compact = False,
+                         extensions = ('.jpg',),
+                         workers = 8,
+                         dry_run = False,
+                         metrics_path = None,
+                         profile_path = None):
+    # metrics_path / profile_path like voc2coco, the run's metrics are returned in report['metrics']
+    with measured_run('remove_unused_images', metrics_path, profile_path, image_path = image_path,
+                      json_path = json_path, dry_run = dry_run) as metrics:
+        with stage(metrics, 'load_json'):
+            with open(json_path) as file:
+                coco = json.load(file)
+
+        # set of file names used by the json, O(1) lookups instead of searching a list
+        used_images = set(image['file_name'] for image in coco['images'])
+        with stage(metrics, 'list_dir'):
+            unused, found = find_unused_images(image_path, used_images, extensions)
+
+        report = {
+            'removed': [name for name, _ in unused],
+            'bytes_reclaimed': sum(size for _, size in unused),
+            'kept': len(found),
+            'missing': sorted(used_images - found)
+        }
+        count(metrics, 'unused_files', len(unused))
+        count(metrics, 'kept_files', len(found))
+        count(metrics, 'missing_image', len(report['missing']))
+
+        if dry_run:
+            print(f'Dry run: would remove {len(unused)} images ({report["bytes_reclaimed"] / 2**20:.1f} MiB) and keep {len(found)}, {len(report["missing"])} images in the json are missing.')
+            report['metrics'] = finish_metrics(metrics)
+            return report
+
+        # remove unused images, deleting is io bound so a small thread pool is enough
+        paths = [os.path.join(image_path, name) for name, _ in unused]
+        with stage(metrics, 'delete'), ThreadPoolExecutor(max_workers = workers) as executor:
+            for _ in executor.map(os.remove, paths):
+                pass
+        count(metrics, 'deleted_files', len(paths))
+        count(metrics, 'bytes_reclaimed', report['bytes_reclaimed'])
     
-    # Serializing json
-    json_object = json.dumps(coco, indent=4)
+        for annotation in coco['annotations']:
+            if 'segmentation' in annotation:
+                annotation.pop('segmentation')
     
-    # Writing to sample.json
-    with open(json_path, "w") as outfile:
-        outfile.write(json_object)
+        # Streaming the json to a temp file and renaming it over the original
+        write_coco(json_path, coco, compact, metrics)
+
+        print(f'Removed {len(unused)} images ({report["bytes_reclaimed"] / 2**20:.1f} MiB) and kept {len(found)}, {len(report["missing"])} images in the json are missing.')
+        report['metrics'] = finish_metrics(metrics)
+        return report
 
-remove_unused_images(image_path = './datasets/320_12/coco_train_label_images_320_012',
-                     json_path = './datasets/320_12/coco_train_label_320_012.json')
\ No newline at end of file
+if __name__ == '__main__':
+    remove_unused_images(image_path = './datasets/320_12/coco_train_label_images_320_012',
+                         json_path = './datasets/320_12/coco_train_label_320_012.json',
+                         metrics_path = 'metrics.jsonl')
@@ -0,0 +1,119 @@
+import os
+import json
+
+import numpy as np
+
+from coco_writer import write_coco
+
+# columnar version of a coco json: every field of the images/annotations lists is stored as one .npy array
+# (e.g. annotations.bbox.npy is an N x 4 array) so it can be memory-mapped instead of parsed.
+# everything else (categories, info, ...) and the key order needed to rebuild the json goes in meta.json
+
+TABLES = ('images', 'annotations')
+# a float column that also had ints (e.g. bbox [10, 20.5, 30, 40.25]) gets a bool column <field>.is_int next to it,
+# so the ints come back as ints
+INT_MASK = '.is_int'
+
+def column_to_array(key, values):
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype = str)
+    if all(isinstance(value, bool) for value in values):
+        return np.array(values, dtype = bool)
+
+    # numbers, or equal length lists of numbers (bbox), anything else would not survive the round trip
+    flat = np.array(values, dtype = object).ravel()
+    if not all(type(value) in (int, float) for value in flat):
+        raise ValueError(f'Field "{key}" can not be stored as a column (ragged, nested or mixed values).')
+
+    # keep ints as ints so the json comes back the same
+    if all(type(value) is int for value in flat):
+        return np.array(values, dtype = np.int64)
+    return np.array(values, dtype = np.float64)
+
+def table_to_columns(name, records):
+    keys = list(records[0].keys()) if records else []
+    for record in records:
+        if list(record.keys()) != keys:
+            raise ValueError(f'Every entry of "{name}" needs the same fields to be stored as columns.')
+    columns = {}
+    for key in keys:
+        values = [record[key] for record in records]
+        columns[key] = column_to_array(key, values)
+        if columns[key].dtype == np.float64:
+            is_int = np.array([type(value) is int for value in np.array(values, dtype = object).ravel()])
+            if is_int.any():
+                columns[key + INT_MASK] = is_int.reshape(columns[key].shape)
+    return columns
+
+def coco_to_columnar(coco):
+    columnar = {}
+    for key, value in coco.items():
+        columnar[key] = table_to_columns(key, value) if key in TABLES else value
+    return columnar
+
+def columns_to_records(columns):
+    keys = [key for key in columns if not key.endswith(INT_MASK)]
+    if not keys:
+        return []
+    values = []
+    for key in keys:
+        if key + INT_MASK not in columns:
+            values.append(columns[key].tolist())
+            continue
+        is_int = np.asarray(columns[key + INT_MASK])
+        column = np.asarray(columns[key]).astype(object)
+        column[is_int] = np.asarray(columns[key])[is_int].astype(np.int64).tolist()
+        values.append(column.tolist())
+    return [dict(zip(keys, row)) for row in zip(*values)]
+
+def columnar_to_coco(columnar):
+    coco = {}
+    for key, value in columnar.items():
+        coco[key] = columns_to_records(value) if key in TABLES else value
+    return coco
+
+def save_columnar(path, coco):
+    columnar = coco_to_columnar(coco)
+    os.makedirs(path, exist_ok = True)
+
+    meta = {'version': 1, 'keys': list(columnar.keys()), 'columns': {}, 'other': {}}
+    for key, value in columnar.items():
+        if key not in TABLES:
+            meta['other'][key] = value
+            continue
+
+        meta['columns'][key] = list(value.keys())
+        for column, array in value.items():
+            np.save(os.path.join(path, f'{key}.{column}.npy'), array)
+
+    # meta.json goes last, a store without it is treated as incomplete
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+def load_columnar(path, mmap_mode = 'r'):
+    # with mmap_mode = 'r' nothing is read until a column is actually used
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+
+    columnar = {}
+    for key in meta['keys']:
+        if key in meta['other']:
+            columnar[key] = meta['other'][key]
+            continue
+        columnar[key] = {column: np.load(os.path.join(path, f'{key}.{column}.npy'), mmap_mode = mmap_mode)
+                         for column in meta['columns'][key]}
+    return columnar
+
+def json_to_columnar(json_path, path):
+    with open(json_path) as file:
+        save_columnar(path, json.load(file))
+
+def columnar_to_json(path, json_path, compact = False):
+    write_coco(json_path, columnar_to_coco(load_columnar(path)), compact)
+
+def load_coco_columns(source):
+    # columnar view of either a store folder or a plain coco json
+    if os.path.isdir(source):
+        return load_columnar(source)
+    with open(source) as file:
+        return coco_to_columnar(json.load(file))
@@ -0,0 +1,255 @@
+import os
+import json
+
+import numpy as np
+
+from coco_columnar import load_coco_columns
+from prediction_store import load_predictions_store
+from result_reader import iter_image_batches
+
+# coco bbox evaluation of a sahi result.json against the ground truth json, without pycocotools or fiftyone.
+# the iou matrix of every image / category is computed once and the greedy matching is done for all iou thresholds
+# at the same time, so the coco metrics (0.5:0.95) and the fiftyone style tp / fp / fn counts at 0.5 and 0.1
+# come out of a single pass. matching and accumulation follow pycocotools' COCOeval
+
+COCO_IOU_THRESHOLDS = tuple(np.round(np.linspace(0.5, 0.95, 10), 2).tolist())
+COUNT_IOU_THRESHOLDS = (0.5, 0.1)
+RECALL_THRESHOLDS = np.linspace(0, 1, 101)
+# same ranges as sahi's coco evaluation
+AREA_RANGES = {'all': (0, 1e5 ** 2), 's': (0, 32 ** 2), 'm': (32 ** 2, 96 ** 2), 'l': (96 ** 2, 1e5 ** 2)}
+
+def group_by(keys, *arrays):
+    # {key: tuple of the arrays' rows with that key}
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return {}
+    order = np.argsort(keys, kind = 'stable')
+    unique, starts = np.unique(keys[order], return_index = True)
+    return {key: tuple(array[indices] for array in arrays) for key, indices in zip(unique.tolist(), np.split(order, starts[1:]))}
+
+def load_ground_truth(gt_source):
+    columns = load_coco_columns(gt_source)
+    annotations = columns['annotations']
+    image_ids = np.asarray(columns['images']['id'])
+    category_ids = np.array([category['id'] for category in columns['categories']])
+    if not annotations:
+        return image_ids, category_ids, {}
+
+    bbox = np.asarray(annotations['bbox'], dtype = np.float64).reshape(-1, 4)
+    area = np.asarray(annotations['area'], dtype = np.float64) if 'area' in annotations else bbox[:, 2] * bbox[:, 3]
+    crowd = np.asarray(annotations['iscrowd'], dtype = bool) if 'iscrowd' in annotations else np.zeros(len(bbox), dtype = bool)
+    keys = np.asarray(annotations['image_id']).astype(np.int64) * 1_000_003 + np.asarray(annotations['category_id'])
+    return image_ids, category_ids, group_by(keys, bbox, area, crowd)
+
+def load_predictions(result_path):
+    # a result.json or a prediction_store directory
+    if os.path.isdir(result_path):
+        store = load_predictions_store(result_path)
+        bbox = np.asarray(store['bbox'], dtype = np.float64).reshape(-1, 4)
+        scores = np.asarray(store['score'], dtype = np.float64)
+        image_ids = np.repeat(np.asarray(store['image_ids']), np.diff(store['offsets']))
+        keys = image_ids * 1_000_003 + np.asarray(store['category_id'], dtype = np.int64)
+        return group_by(keys, bbox, scores, bbox[:, 2] * bbox[:, 3])
+
+    with open(result_path) as file:
+        results = json.load(file)
+    bbox = np.array([result['bbox'] for result in results], dtype = np.float64).reshape(-1, 4)
+    scores = np.array([result['score'] for result in results], dtype = np.float64)
+    keys = np.array([result['image_id'] * 1_000_003 + result['category_id'] for result in results], dtype = np.int64)
+    # like pycocotools loadRes, the area of a detection is its box area
+    return group_by(keys, bbox, scores, bbox[:, 2] * bbox[:, 3])
+
+def box_iou(dt_boxes, gt_boxes, gt_crowd):
+    # xywh boxes, detections x ground truths. crowd ground truths use the detection area as the union (pycocotools)
+    dt = np.concatenate([dt_boxes[:, :2], dt_boxes[:, :2] + dt_boxes[:, 2:]], axis = 1)
+    gt = np.concatenate([gt_boxes[:, :2], gt_boxes[:, :2] + gt_boxes[:, 2:]], axis = 1)
+    width = np.clip(np.minimum(dt[:, None, 2], gt[None, :, 2]) - np.maximum(dt[:, None, 0], gt[None, :, 0]), 0, None)
+    height = np.clip(np.minimum(dt[:, None, 3], gt[None, :, 3]) - np.maximum(dt[:, None, 1], gt[None, :, 1]), 0, None)
+    intersection = width * height
+
+    dt_area = (dt_boxes[:, 2] * dt_boxes[:, 3])[:, None]
+    gt_area = (gt_boxes[:, 2] * gt_boxes[:, 3])[None, :]
+    union = np.where(gt_crowd[None, :], dt_area, dt_area + gt_area - intersection)
+    return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0)
+
+def best_match(ious, candidates):
+    # pycocotools keeps the last ground truth with the highest iou, per threshold row
+    if candidates.shape[1] == 0:
+        return np.full(len(candidates), -1)
+    scores = np.where(candidates, ious, -1)
+    last = scores.shape[1] - 1 - np.argmax(scores[:, ::-1], axis = 1)
+    return np.where(candidates.any(axis = 1), last, -1)
+
+def match_image(ious, gt_area, gt_crowd, dt_area, thresholds, area_range):
+    # greedy matching of the score sorted detections for every threshold at once, returns
+    # (thresholds x detections) matched / ignored flags and the number of not ignored ground truths
+    gt_ignore = gt_crowd | (gt_area < area_range[0]) | (gt_area > area_range[1])
+    order = np.argsort(gt_ignore, kind = 'mergesort')
+    ious = ious[:, order]
+    gt_ignore = gt_ignore[order]
+    gt_crowd = gt_crowd[order]
+    n_valid = int((~gt_ignore).sum())
+
+    n_thresholds = len(thresholds)
+    n_dt, n_gt = ious.shape
+    gt_matched = np.zeros((n_thresholds, n_gt), dtype = bool)
+    dt_matched = np.zeros((n_thresholds, n_dt), dtype = bool)
+    dt_ignore = np.zeros((n_thresholds, n_dt), dtype = bool)
+    rows = np.arange(n_thresholds)
+    minimum = np.minimum(thresholds, 1 - 1e-10)[:, None]
+
+    for dt_index in range(n_dt):
+        candidates = (~gt_matched | gt_crowd[None, :]) & (ious[dt_index][None, :] >= minimum)
+        # not ignored ground truths first, ignored ones only if nothing else matches
+        match = best_match(ious[dt_index][None, :n_valid].repeat(n_thresholds, 0), candidates[:, :n_valid])
+        fallback = best_match(ious[dt_index][None, n_valid:].repeat(n_thresholds, 0), candidates[:, n_valid:])
+        match = np.where(match >= 0, match, np.where(fallback >= 0, fallback + n_valid, -1))
+
+        found = match >= 0
+        gt_matched[rows[found], match[found]] = True
+        dt_matched[found, dt_index] = True
+        dt_ignore[found, dt_index] = gt_ignore[match[found]]
+
+    # unmatched detections outside the area range don't count
+    outside = (dt_area < area_range[0]) | (dt_area > area_range[1])
+    dt_ignore |= ~dt_matched & outside[None, :]
+    return dt_matched, dt_ignore, n_valid
+
+def average_precision(scores, matched, ignored, n_valid):
+    # pycocotools' accumulate for one category / area range, every threshold row at once.
+    # returns precision at the 101 recall points (thresholds x 101) or None when there is no ground truth
+    if n_valid == 0:
+        return None
+    order = np.argsort(-scores, kind = 'mergesort')
+    matched = matched[:, order]
+    ignored = ignored[:, order]
+
+    tp = np.cumsum(matched & ~ignored, axis = 1, dtype = np.float64)
+    fp = np.cumsum(~matched & ~ignored, axis = 1, dtype = np.float64)
+    precision = np.zeros((len(matched), len(RECALL_THRESHOLDS)))
+    for row in range(len(matched)):
+        recall = tp[row] / n_valid
+        row_precision = tp[row] / (fp[row] + tp[row] + np.spacing(1))
+        # make precision monotonically decreasing
+        row_precision = np.maximum.accumulate(row_precision[::-1])[::-1]
+        indices = np.searchsorted(recall, RECALL_THRESHOLDS, side = 'left')
+        valid = indices < len(row_precision)
+        precision[row, valid] = row_precision[indices[valid]]
+    return precision
+
+def evaluate(gt_source, result_path, max_detections = 500, count_thresholds = COUNT_IOU_THRESHOLDS, stream = False):
+    # stream reads the result file one image at a time (result_reader) instead of loading it whole
+    predictions = iter_image_batches(result_path, assume_grouped = False) if stream else load_predictions(result_path)
+    return evaluate_predictions(load_ground_truth(gt_source), predictions, max_detections, count_thresholds)
+
+def batch_to_predictions(image_id, bbox, scores, categories):
+    # one image of result_reader.iter_image_batches in the {key: (bbox, scores, area)} form of load_predictions
+    return group_by(image_id * 1_000_003 + categories, bbox, scores, bbox[:, 2] * bbox[:, 3])
+
+def evaluate_image(collected, gt, predictions, image_id, category_ids, thresholds, max_detections):
+    empty_gt = (np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype = bool))
+    empty_dt = (np.zeros((0, 4)), np.zeros(0), np.zeros(0))
+    for category in category_ids:
+        key = image_id * 1_000_003 + category
+        gt_boxes, gt_area, gt_crowd = gt.get(key, empty_gt)
+        dt_boxes, dt_scores, dt_area = predictions.get(key, empty_dt)
+        if len(gt_boxes) == 0 and len(dt_boxes) == 0:
+            continue
+
+        order = np.argsort(-dt_scores, kind = 'mergesort')[:max_detections]
+        dt_boxes, dt_scores, dt_area = dt_boxes[order], dt_scores[order], dt_area[order]
+        # computed once, reused for every area range and threshold
+        ious = box_iou(dt_boxes, gt_boxes, gt_crowd)
+
+        for area, area_range in AREA_RANGES.items():
+            matched, ignored, n_valid = match_image(ious, gt_area, gt_crowd, dt_area, thresholds, area_range)
+            collected[(area, category)].append((image_id, dt_scores, matched, ignored, n_valid))
+
+def evaluate_predictions(ground_truth, predictions, max_detections = 500, count_thresholds = COUNT_IOU_THRESHOLDS):
+    # ground_truth from load_ground_truth, so the gt can be loaded once for many runs. predictions from load_predictions,
+    # or an iterable of (image id, xywh boxes, scores, category ids) per image like result_reader.iter_image_batches
+    image_ids, category_ids, gt = ground_truth
+    category_ids = category_ids.tolist()
+    thresholds = np.array(COCO_IOU_THRESHOLDS + tuple(count_thresholds))
+
+    # per area range and category: detection scores, matched / ignored flags and the number of ground truths of every image
+    collected = {(area, category): [] for area in AREA_RANGES for category in category_ids}
+    gt_images = set(image_ids.tolist())
+    if isinstance(predictions, dict):
+        for image_id in gt_images:
+            evaluate_image(collected, gt, predictions, image_id, category_ids, thresholds, max_detections)
+    else:
+        # only the detections of one image are in memory at a time, images without detections are done at the end
+        for image_id, bbox, scores, categories in predictions:
+            if image_id in gt_images:
+                gt_images.discard(image_id)
+                evaluate_image(collected, gt, batch_to_predictions(image_id, bbox, scores, categories),
+                               image_id, category_ids, thresholds, max_detections)
+        for image_id in gt_images:
+            evaluate_image(collected, gt, {}, image_id, category_ids, thresholds, max_detections)
+
+    n_coco = len(COCO_IOU_THRESHOLDS)
+    precision = {area: [] for area in AREA_RANGES}
+    counts = {threshold: {'tp': 0, 'fp': 0, 'fn': 0} for threshold in count_thresholds}
+    for (area, category), images in collected.items():
+        if not images:
+            continue
+        # in image id order like pycocotools, so equal scores are ordered the same way
+        images.sort(key = lambda image: image[0])
+        scores = np.concatenate([image[1] for image in images])
+        matches = np.concatenate([image[2] for image in images], axis = 1)
+        ignores = np.concatenate([image[3] for image in images], axis = 1)
+        n_valid = sum(image[4] for image in images)
+
+        result = average_precision(scores, matches[:n_coco], ignores[:n_coco], n_valid)
+        if result is not None:
+            precision[area].append(result)
+
+        if area == 'all':
+            for row, threshold in enumerate(count_thresholds, start = n_coco):
+                tp = int((matches[row] & ~ignores[row]).sum())
+                counts[threshold]['tp'] += tp
+                counts[threshold]['fp'] += int((~matches[row] & ~ignores[row]).sum())
+                counts[threshold]['fn'] += n_valid - tp
+
+    def mean_ap(area, iou = None):
+        if not precision[area]:
+            return -1.0
+        values = np.stack(precision[area])
+        if iou is not None:
+            values = values[:, COCO_IOU_THRESHOLDS.index(iou)]
+        return float(values.mean())
+
+    metrics = {
+        'bbox_mAP': mean_ap('all'),
+        'bbox_mAP50': mean_ap('all', 0.5),
+        'bbox_mAP75': mean_ap('all', 0.75),
+        'bbox_mAP_s': mean_ap('s'),
+        'bbox_mAP_m': mean_ap('m'),
+        'bbox_mAP_l': mean_ap('l'),
+        'bbox_mAP50_s': mean_ap('s', 0.5),
+        'bbox_mAP50_m': mean_ap('m', 0.5),
+        'bbox_mAP50_l': mean_ap('l', 0.5)
+    }
+    metrics = {key: round(value, 3) for key, value in metrics.items()}
+    # same order as the copypaste line in sahi's eval.json
+    metrics['bbox_mAP_copypaste'] = ' '.join(f'{metrics[key]:.3f}' for key in
+                                             ['bbox_mAP', 'bbox_mAP75', 'bbox_mAP50', 'bbox_mAP_s', 'bbox_mAP_m',
+                                              'bbox_mAP_l', 'bbox_mAP50_s', 'bbox_mAP50_m', 'bbox_mAP50_l'])
+
+    # fiftyone style report at the count thresholds
+    for threshold, count in counts.items():
+        tp, fp, fn = count['tp'], count['fp'], count['fn']
+        count['precision'] = tp / (tp + fp) if tp + fp else 0.0
+        count['recall'] = tp / (tp + fn) if tp + fn else 0.0
+        count['f1'] = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+    metrics['counts'] = {f'{threshold:g}': count for threshold, count in counts.items()}
+    return metrics
+
+def write_eval_json(metrics, path):
+    with open(path, 'w') as file:
+        json.dump(metrics, file, indent = 4)
+
+if __name__ == '__main__':
+    metrics = evaluate('../heridal/testImages/coco_test_label.json', './runs/100e_16b_auto/sahi/320_20/result.json')
+    print(json.dumps(metrics, indent = 4))
@@ -0,0 +1,96 @@
+import os
+import json
+import tempfile
+import time
+
+from run_metrics import add_time, count
+
+# write a coco dict to disk one image/annotation at a time instead of building one big json.dumps string.
+# lists (or any iterable, e.g. a generator) inside the dict are streamed item by item.
+# compact = False gives exactly the same bytes as json.dumps(coco, indent=4)
+# the file is written to a temp file next to the target and renamed over it, so a crash never leaves half a json
+
+def is_stream(value):
+    return not isinstance(value, (str, bytes, dict)) and hasattr(value, '__iter__')
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_coco_chunks(coco, compact = False, batch_size = 1000):
+    # one encoder for the whole file, and list items are encoded a batch at a time to keep the per-call overhead low
+    if compact:
+        dump = json.JSONEncoder(separators=(',', ':')).encode
+        open_obj, close_obj, key_sep, item_sep = '{', '}', ':', ','
+        open_list, close_list, batch_sep = '[', ']', ','
+        strip_batch = lambda text: text[1:-1]
+    else:
+        dump = json.JSONEncoder(indent=4).encode
+        open_obj, close_obj, key_sep, item_sep = '{\n    ', '\n}', ': ', ',\n    '
+        open_list, close_list, batch_sep = '[\n', '\n    ]', ',\n'
+        # a batch comes out as "[\n    {...},\n    {...}\n]", drop the brackets and indent it one more level
+        strip_batch = lambda text: '    ' + text[2:-2].replace('\n', '\n    ')
+
+    if len(coco) == 0:
+        yield '{}'
+        return
+
+    yield open_obj
+    for key_index, (key, value) in enumerate(coco.items()):
+        if key_index > 0:
+            yield item_sep
+        yield dump(key) + key_sep
+
+        if not is_stream(value):
+            yield dump(value) if compact else dump(value).replace('\n', '\n    ')
+            continue
+
+        empty = True
+        for batch in iter_batches(value, batch_size):
+            yield open_list if empty else batch_sep
+            yield strip_batch(dump(batch))
+            empty = False
+        yield '[]' if empty else close_list
+    yield close_obj
+
+def write_coco(filename, coco, compact = False, metrics = None):
+    # metrics (from run_metrics.measured_run) gets the time spent encoding (serialize) and writing (write) and
+    # the bytes written
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir = directory, prefix = '.' + os.path.basename(filename), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'w', buffering = 1 << 20) as outfile:
+            if metrics is None:
+                for chunk in iter_coco_chunks(coco, compact):
+                    outfile.write(chunk)
+            else:
+                serialize_seconds = write_seconds = 0.0
+                chunks = iter_coco_chunks(coco, compact)
+                while True:
+                    start = time.perf_counter()
+                    chunk = next(chunks, None)
+                    middle = time.perf_counter()
+                    serialize_seconds += middle - start
+                    if chunk is None:
+                        break
+                    outfile.write(chunk)
+                    write_seconds += time.perf_counter() - middle
+                start = time.perf_counter()
+                # the last buffered megabyte, the os may still be holding it in the page cache
+                outfile.flush()
+                write_seconds += time.perf_counter() - start
+                add_time(metrics, 'serialize', serialize_seconds)
+                add_time(metrics, 'write', write_seconds)
+                count(metrics, 'bytes_written', outfile.tell())
+        # mkstemp creates the file as 0600, keep the permissions a plain open() would have given
+        os.chmod(temp_filename, os.stat(filename).st_mode if os.path.exists(filename) else 0o644)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
@@ -0,0 +1,127 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from coco_evaluator import AREA_RANGES, load_ground_truth, load_predictions, box_iou, match_image
+from batch_evaluate import find_results, config_row, write_table
+
+# precision / recall / f1 of a result.json at every confidence threshold, like ultralytics' F1_curve.png and
+# PR_curve.png but for the full image sliced predictions. the detections are matched greedily from the highest
+# score down, so a detection's match only depends on the detections above it: matching once with everything and
+# taking cumulative sums over the score sorted detections gives the result of every threshold in one pass
+
+SWEEP_IOU_THRESHOLDS = (0.5, 0.1)
+CONFIDENCES = np.round(np.linspace(0, 1, 101), 2)
+
+def match_detections(ground_truth, predictions, iou_thresholds = SWEEP_IOU_THRESHOLDS):
+    # scores, (thresholds x detections) true and false positive flags of all detections and the number of ground truths
+    image_ids, category_ids, gt = ground_truth
+    empty_gt = (np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype = bool))
+    thresholds = np.array(iou_thresholds)
+
+    scores, true_positives, false_positives = [], [], []
+    n_gt = 0
+    for image_id in image_ids.tolist():
+        for category in category_ids.tolist():
+            key = image_id * 1_000_003 + category
+            gt_boxes, gt_area, gt_crowd = gt.get(key, empty_gt)
+            n_gt += int((~gt_crowd).sum())
+            if key not in predictions:
+                continue
+            dt_boxes, dt_scores, dt_area = predictions[key]
+            order = np.argsort(-dt_scores, kind = 'mergesort')
+            dt_boxes, dt_scores, dt_area = dt_boxes[order], dt_scores[order], dt_area[order]
+
+            matched, ignored, _ = match_image(box_iou(dt_boxes, gt_boxes, gt_crowd), gt_area, gt_crowd, dt_area,
+                                              thresholds, AREA_RANGES['all'])
+            # detections matched to a crowd region are neither true nor false positives
+            scores.append(dt_scores)
+            true_positives.append(matched & ~ignored)
+            false_positives.append(~matched & ~ignored)
+
+    if not scores:
+        empty = np.zeros((len(thresholds), 0), dtype = bool)
+        return np.zeros(0), empty, empty, n_gt
+    return np.concatenate(scores), np.concatenate(true_positives, axis = 1), np.concatenate(false_positives, axis = 1), n_gt
+
+def at(values, counts):
+    # the cumulative value after the first counts detections, 0 where none are kept
+    return np.where(counts > 0, values[np.maximum(counts - 1, 0)] if len(values) else 0.0, 0.0)
+
+def sweep_curves(scores, true_positives, false_positives, n_gt, iou_thresholds = SWEEP_IOU_THRESHOLDS, confidences = CONFIDENCES):
+    # {iou: curves at the given confidences plus the f1-optimal threshold}, the optimum is searched over every
+    # distinct detection score, not only the confidence grid
+    order = np.argsort(-scores, kind = 'mergesort')
+    scores = scores[order]
+    # detections kept at a threshold t are the ones with score >= t, the first count_at[i] of the sorted list
+    count_at = len(scores) - np.searchsorted(scores[::-1], confidences, side = 'left')
+    # the last detection of every run of equal scores, only there can the threshold be placed
+    ends = np.flatnonzero(np.r_[scores[1:] != scores[:-1], True]) if len(scores) else np.zeros(0, dtype = np.int64)
+
+    curves = {}
+    for row, iou in enumerate(iou_thresholds):
+        tp = np.cumsum(true_positives[row, order], dtype = np.float64)
+        fp = np.cumsum(false_positives[row, order], dtype = np.float64)
+        precision = tp / np.maximum(tp + fp, 1)
+        recall = tp / max(n_gt, 1)
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-16)
+
+        best = ends[np.argmax(f1[ends])] if len(ends) else None
+        curves[f'{iou:g}'] = {
+            'confidence': confidences.tolist(),
+            # like ultralytics, precision is 1 where nothing is kept
+            'precision': np.where(count_at > 0, at(precision, count_at), 1.0).tolist(),
+            'recall': at(recall, count_at).tolist(),
+            'f1': at(f1, count_at).tolist(),
+            'best_threshold': float(scores[best]) if best is not None else None,
+            'best_f1': float(f1[best]) if best is not None else 0.0,
+            'best_precision': float(precision[best]) if best is not None else 0.0,
+            'best_recall': float(recall[best]) if best is not None else 0.0,
+            'tp': int(tp[best]) if best is not None else 0,
+            'fp': int(fp[best]) if best is not None else 0,
+            'fn': n_gt - int(tp[best]) if best is not None else n_gt
+        }
+    return curves
+
+def confidence_sweep(ground_truth, result_path, iou_thresholds = SWEEP_IOU_THRESHOLDS, confidences = CONFIDENCES):
+    return sweep_curves(*match_detections(ground_truth, load_predictions(result_path), iou_thresholds), iou_thresholds, confidences)
+
+# same pattern as batch_evaluate, the ground truth is handed to the workers once
+worker_ground_truth = None
+
+def init_worker(ground_truth):
+    global worker_ground_truth
+    worker_ground_truth = ground_truth
+
+def sweep_result(result_path):
+    return confidence_sweep(worker_ground_truth, result_path)
+
+def sweep_runs(gt_source, runs_dir = 'runs', output_path = 'thresholds.csv', workers = 4):
+    # best threshold of every runs/*/sahi/*/result.json, the full curves go in a sweep.json next to each result
+    result_paths = find_results(runs_dir)
+    ground_truth = load_ground_truth(gt_source)
+    if workers <= 1:
+        init_worker(ground_truth)
+        sweeps = [sweep_result(path) for path in result_paths]
+    else:
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (ground_truth,)) as executor:
+            sweeps = list(executor.map(sweep_result, result_paths))
+
+    rows = []
+    for result_path, curves in zip(result_paths, sweeps):
+        with open(os.path.join(os.path.dirname(result_path), 'sweep.json'), 'w') as file:
+            json.dump(curves, file)
+        row = config_row(result_path)
+        for iou, curve in curves.items():
+            for key in ('best_threshold', 'best_f1', 'best_precision', 'best_recall', 'tp', 'fp', 'fn'):
+                row[f'{key}@{iou}'] = curve[key]
+        rows.append(row)
+
+    write_table(rows, output_path)
+    print(f'Swept {len(rows)} result files, best thresholds written to "{output_path}".')
+    return rows
+
+if __name__ == '__main__':
+    sweep_runs('../heridal/testImages/coco_test_label.json', workers = os.cpu_count())
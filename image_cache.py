@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+# decoded full-res images kept on disk as raw uint8 .npy files, keyed by the sha1 of the jpg, so slicing and every
+# sahi config can memory-map the pixels instead of decoding the same 4000 x 3000 jpg again.
+# the hash of a source file is remembered (by size and mtime, like voc2coco's manifest) in one small file per path,
+# so workers in different processes can share a cache folder. the mtime of an entry is its last use, entries are
+# evicted least recently used first when the folder grows over max_bytes
+
+MAX_BYTES = 20 * 2**30
+
+def open_image_cache(cache_dir, max_bytes = MAX_BYTES):
+    os.makedirs(os.path.join(cache_dir, 'paths'), exist_ok = True)
+    return {'dir': cache_dir, 'max_bytes': max_bytes, 'hits': 0, 'misses': 0, 'evictions': 0,
+            'decode_seconds': 0.0, 'load_seconds': 0.0}
+
+def atomic_write(path, write):
+    # write to a temporary file next to path and move it in place, readers never see half a file
+    handle, temp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def source_hash(cache, path):
+    stat = os.stat(path)
+    memo_path = os.path.join(cache['dir'], 'paths', hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.json')
+    if os.path.exists(memo_path):
+        with open(memo_path) as file:
+            memo = json.load(file)
+        if memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime_ns:
+            return memo['hash']
+
+    with open(path, 'rb') as file:
+        digest = hashlib.sha1(file.read()).hexdigest()
+    memo = json.dumps({'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest})
+    atomic_write(memo_path, lambda file: file.write(memo.encode('utf-8')))
+    return digest
+
+def add_lookup(cache, hit, seconds, evicted = 0):
+    # counts one cached_decode in the cache stats, also used to add up lookups done on copies of the cache in
+    # worker processes (slicer.slice_coco)
+    if hit:
+        cache['hits'] += 1
+        cache['load_seconds'] += seconds
+    else:
+        cache['misses'] += 1
+        cache['decode_seconds'] += seconds
+    cache['evictions'] += evicted
+
+def cached_decode(cache, path):
+    # (read-only memory-mapped h x w x 3 array, whether it was cached, seconds, entries evicted to make room).
+    # like sliced_inference.decode_image but decoded only once, the lookup is also counted in cache
+    start = time.perf_counter()
+    entry = os.path.join(cache['dir'], source_hash(cache, path) + '.npy')
+    try:
+        array = np.load(entry, mmap_mode = 'r')
+        # the mtime is the lru clock
+        os.utime(entry)
+        seconds = time.perf_counter() - start
+        add_lookup(cache, True, seconds)
+        return array, True, seconds, 0
+    except FileNotFoundError:
+        pass
+
+    with Image.open(path) as image:
+        decoded = np.asarray(image.convert('RGB'))
+    atomic_write(entry, lambda file: np.save(file, decoded))
+    evicted = evict(cache, keep = entry)
+    array = np.load(entry, mmap_mode = 'r')
+    seconds = time.perf_counter() - start
+    add_lookup(cache, False, seconds, evicted)
+    return array, False, seconds, evicted
+
+def cache_entries(cache):
+    # (last use, bytes, path) of every cached image, files removed by another process meanwhile are left out
+    entries = []
+    for entry in os.scandir(cache['dir']):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    return entries
+
+def evict(cache, keep = None):
+    # least recently used entries first until the cache fits in max_bytes, keep is never evicted.
+    # returns the number of entries removed
+    entries = cache_entries(cache)
+    evicted = 0
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache['max_bytes']:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # still mapped by another process (windows) or already evicted by one, skipped this time
+            continue
+        total -= size
+        evicted += 1
+    return evicted
+
+def cache_report(cache):
+    entries = cache_entries(cache)
+    lookups = cache['hits'] + cache['misses']
+    report = {
+        'hits': cache['hits'],
+        'misses': cache['misses'],
+        'hit_rate': cache['hits'] / lookups if lookups else 0.0,
+        'evictions': cache['evictions'],
+        'entries': len(entries),
+        'bytes': sum(size for _, size, _ in entries),
+        'max_bytes': cache['max_bytes'],
+        'mean_decode_ms': cache['decode_seconds'] / cache['misses'] * 1000 if cache['misses'] else None,
+        'mean_load_ms': cache['load_seconds'] / cache['hits'] * 1000 if cache['hits'] else None
+    }
+    print(f'Image cache: {report["hits"]} hits, {report["misses"]} misses ({report["hit_rate"]:.1%}), '
+          f'{report["evictions"]} evicted, {report["bytes"] / 2**30:.2f} of {report["max_bytes"] / 2**30:.2f} GiB used.')
+    return report
+
+if __name__ == '__main__':
+    # decode every test image once so the sliced inference runs after this only load them
+    cache = open_image_cache('./image_cache')
+    for file_name in sorted(os.listdir('../heridal/testImages')):
+        if file_name.lower().endswith('.jpg'):
+            cached_decode(cache, os.path.join('../heridal/testImages', file_name))
+    cache_report(cache)
@@ -1,68 +1,152 @@
 import os
-import xml.etree.ElementTree as ET
-import math
+import json
 
+import numpy as np
 
-def optimize_overlap(label_folder, target_crop_w, target_crop_h):
-    files = os.listdir(label_folder)
+from voc2coco import parse_voc_files
+from coco_columnar import load_columnar
+from run_metrics import measured_run, stage, count
 
-    max_w = 0
-    max_h = 0
-    all_w = list()
-    all_h = list()
 
-    for file in files:
-        if file.endswith(".xml"):
-            # read xml and calculate width and height of objects
-            tree = ET.parse(os.path.join(label_folder, file))
-            root = tree.getroot()
+def load_box_sizes(source, workers=1, metrics=None, voc_inclusive=False):
+    # collect the width and height of every object once, from a voc label folder,
+    # a coco json or a columnar store (folder with meta.json)
+    if os.path.isdir(source) and os.path.exists(os.path.join(source, "meta.json")):
+        with stage(metrics, "load"):
+            bbox = load_columnar(source)["annotations"]["bbox"]
+            widths, heights = np.asarray(bbox[:, 2]), np.asarray(bbox[:, 3])
+        count(metrics, "boxes", len(widths))
+        return widths, heights
 
-            for object in tree.findall("object"):
-                min_x = int(object.find("bndbox").find("xmin").text)
-                min_y = int(object.find("bndbox").find("ymin").text)
-                max_x = int(object.find("bndbox").find("xmax").text)
-                max_y = int(object.find("bndbox").find("ymax").text)
+    if os.path.isdir(source):
+        with stage(metrics, "list_dir"):
+            files = [
+                os.path.join(source, file)
+                for file in os.listdir(source)
+                if file.endswith(".xml")
+            ]
+        with stage(metrics, "parse"):
+            records = parse_voc_files(files, workers)
+        extra = 1 if voc_inclusive else 0
+        widths = []
+        heights = []
+        with stage(metrics, "index"):
+            for record in records:
+                if record is None:
+                    count(metrics, "bad_xml")
+                    continue
+                # max - min like voc2coco's bbox, so a label folder and the coco json made from it give
+                # the same table. voc_inclusive counts the coordinates as inclusive (+ 1) like optimize_overlap did
+                for _, min_x, min_y, max_x, max_y in record["objects"]:
+                    widths.append(max_x - min_x + extra)
+                    heights.append(max_y - min_y + extra)
+        count(metrics, "xml_files", len(files))
+        count(metrics, "boxes", len(widths))
+        return np.array(widths), np.array(heights)
 
-            curr_w = max_x - min_x + 1
-            curr_h = max_y - min_y + 1
+    with stage(metrics, "load"):
+        with open(source) as file:
+            annotations = json.load(file)["annotations"]
+        bbox = np.array([annotation["bbox"] for annotation in annotations]).reshape(-1, 4)
+    count(metrics, "boxes", len(bbox))
+    return bbox[:, 2], bbox[:, 3]
 
-            if max_w < curr_w:
-                max_w = curr_w
-            if max_h < curr_h:
-                max_h = curr_h
-
-            all_w.append(curr_w)
-            all_h.append(curr_h)
 
+def overlap_table(widths, heights, crop_sizes, percentiles=(50, 90, 95, 99)):
     # worst case is when crop is directly in the middle (both side is 50% of orig object)
-    # calculating optimal overlaps
-    optimal_overlap_w = max_w / 2 / target_crop_w * 100
-    optimal_overlap_h = max_h / 2 / target_crop_h * 100
+    # so the overlap needed to keep an object of size s whole in a crop c is s / 2 / c
+    statistics = ["max", "mean"] + [f"p{percentile:g}" for percentile in percentiles]
+    object_w = np.array(
+        [widths.max(), widths.mean()] + list(np.percentile(widths, percentiles))
+    )
+    object_h = np.array(
+        [heights.max(), heights.mean()] + list(np.percentile(heights, percentiles))
+    )
+
+    crops = np.array(
+        [(size, size) if np.isscalar(size) else size for size in crop_sizes]
+    )
+    overlap_w = np.ceil(object_w[None, :] / 2 / crops[:, 0, None] * 100) / 100
+    overlap_h = np.ceil(object_h[None, :] / 2 / crops[:, 1, None] * 100) / 100
+
+    table = []
+    for crop_index, (crop_w, crop_h) in enumerate(crops.tolist()):
+        for statistic_index, statistic in enumerate(statistics):
+            table.append(
+                {
+                    "crop_w": crop_w,
+                    "crop_h": crop_h,
+                    "statistic": statistic,
+                    "object_w": float(object_w[statistic_index]),
+                    "object_h": float(object_h[statistic_index]),
+                    "overlap_w": float(overlap_w[crop_index, statistic_index]),
+                    "overlap_h": float(overlap_h[crop_index, statistic_index]),
+                }
+            )
+    return table
+
+
+def optimize_overlap_sweep(
+    source,
+    crop_sizes=(320, 512, 640, 1280),
+    percentiles=(50, 90, 95, 99),
+    workers=1,
+    metrics_path=None,
+    profile_path=None,
+    voc_inclusive=False,
+):
+    # metrics_path / profile_path like voc2coco
+    with measured_run(
+        "optimize_overlap", metrics_path, profile_path, source=source, workers=workers
+    ) as metrics:
+        widths, heights = load_box_sizes(source, workers, metrics, voc_inclusive)
+        with stage(metrics, "table"):
+            table = overlap_table(widths, heights, crop_sizes, percentiles)
+    return table
+
+
+def print_overlap_table(table):
+    print(
+        f"{'crop':>11} {'statistic':>9} {'object w':>9} {'object h':>9} {'overlap w':>9} {'overlap h':>9}"
+    )
+    for row in table:
+        print(
+            f"{row['crop_w']:>5} x {row['crop_h']:<5} {row['statistic']:>9} {row['object_w']:9.1f} "
+            f"{row['object_h']:9.1f} {row['overlap_w']:9.2f} {row['overlap_h']:9.2f}"
+        )
+
+
+def optimize_overlap(label_folder, target_crop_w, target_crop_h, metrics_path=None):
+    # keeps the sizes it always printed for a label folder (inclusive voc coordinates)
+    table = optimize_overlap_sweep(
+        label_folder,
+        [(target_crop_w, target_crop_h)],
+        percentiles=(),
+        metrics_path=metrics_path,
+        voc_inclusive=True,
+    )
+    largest, average = table
+
     print(f"\n>>> Optimal overlap for {target_crop_w} x {target_crop_h} crop\n")
-    print(f"===== Based on largest width({max_w}) and height({max_h}) =====")
-    print("width overlap:", math.ceil(optimal_overlap_w) / 100)
-    print("height overlap:", math.ceil(optimal_overlap_h) / 100)
-    ave_w = sum(all_w) / len(all_w)
-    ave_h = sum(all_h) / len(all_h)
-    optimal_overlap_w = ave_w / 2 / target_crop_w * 100
-    optimal_overlap_h = ave_h / 2 / target_crop_h * 100
     print(
-        f"\n===== Based on average width({round(ave_w)}) and height({round(ave_h)}) ====="
+        f"===== Based on largest width({largest['object_w']:g}) and height({largest['object_h']:g}) ====="
+    )
+    print("width overlap:", largest["overlap_w"])
+    print("height overlap:", largest["overlap_h"])
+    print(
+        f"\n===== Based on average width({round(average['object_w'])}) and height({round(average['object_h'])}) ====="
     )
-    print("width overlap:", math.ceil(optimal_overlap_w) / 100)
-    print("height overlap:", math.ceil(optimal_overlap_h) / 100)
+    print("width overlap:", average["overlap_w"])
+    print("height overlap:", average["overlap_h"])
+    return table
 
 
 # note to future self, accept objects that are still 75% whole after crop to remove dupes while minimizing crops for a bit faster training
-# optimize_overlap(
-#     "C:/Users/Japh/Documents/Thesis2/heridal/trainImages/labels/", 320, 320
-# )
-# optimize_overlap(
-#     "C:/Users/Japh/Documents/Thesis2/heridal/trainImages/labels/", 640, 640
-# )
-# optimize_overlap(
-#     "C:/Users/Japh/Documents/Thesis2/heridal/trainImages/labels/", 512, 512
-# )
-optimize_overlap(
-    "C:/Users/Japh/Documents/Thesis2/heridal/trainImages/labels/", 1280, 1280
-)
+if __name__ == "__main__":
+    print_overlap_table(
+        optimize_overlap_sweep(
+            "C:/Users/Japh/Documents/Thesis2/heridal/trainImages/labels/",
+            crop_sizes=(320, 512, 640, 1280),
+            metrics_path="metrics.jsonl",
+        )
+    )
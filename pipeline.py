@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from voc2coco import voc2coco, manifest_path
+from slicer import slice_coco
+from cleanup import remove_unused_images
+from optimal_overlap_calcu import optimize_overlap_sweep
+from coco_evaluator import evaluate, write_eval_json
+from image_cache import open_image_cache
+
+# runs convert -> slice -> prune -> stats -> evaluate from a json config instead of editing the __main__ blocks:
+#
+#   python pipeline.py pipeline.json [--force stage ...] [--dry-run] [--workers 4]
+#
+# every stage is {"tool": ..., "params": {...}, "after": [...]}, params are the keyword arguments of the tool.
+# a stage depends on the earlier stages (in config order) that write one of the paths it reads or writes, plus the
+# ones in after. a stage is skipped when its params, its inputs (size and mtime of every file, like voc2coco's
+# manifest) and its outputs are what they were when it last ran and none of its dependencies runs again.
+# the state is kept in <config>.state.json, stages that do not depend on each other (the train and test splits,
+# several slice configs) run at the same time in separate processes
+
+def overlap_stats(source, output_path, crop_sizes = (320, 512, 640, 1280), percentiles = (50, 90, 95, 99), workers = 1,
+                  metrics_path = None):
+    table = optimize_overlap_sweep(source, crop_sizes, percentiles, workers, metrics_path)
+    with open(output_path, 'w') as file:
+        json.dump(table, file, indent = 4)
+    return table
+
+def evaluate_to_json(gt_source, result_path, output_path, stream = False):
+    metrics = evaluate(gt_source, result_path, stream = stream)
+    write_eval_json(metrics, output_path)
+    return metrics
+
+def slice_to_coco(image_cache_dir = None, **params):
+    # the image cache cannot be given in a json config, its folder is
+    if image_cache_dir is not None:
+        params['image_cache'] = open_image_cache(image_cache_dir)
+    return slice_coco(**params)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# tool: (function, params that are paths it reads, params that are paths it writes, {input folder param: the
+# extensions of the files the tool reads from it, or the param that has them}). only those files count for the
+# fingerprint, editing the labels subfolder of an image folder does not rerun the stages that read the images.
+# prune rewrites its inputs, it is for folders sliced by sahi (which keeps the empty slices), slice only writes
+# the tiles that are in its json
+TOOLS = {
+    'voc2coco': (voc2coco, ('ann_dir', 'img_dir'), ('output_filename', 'columnar_dir'),
+                 {'ann_dir': ('.xml',), 'img_dir': 'img_file_extension'}),
+    'slice': (slice_to_coco, ('coco_path', 'image_dir'), ('output_dir', 'output_filename'), {'image_dir': IMAGE_EXTENSIONS}),
+    'prune': (remove_unused_images, ('image_path', 'json_path'), ('image_path', 'json_path'), {}),
+    'overlap_stats': (overlap_stats, ('source',), ('output_path',), {}),
+    'evaluate': (evaluate_to_json, ('gt_source', 'result_path'), ('output_path',), {})
+}
+
+def load_config(config_path):
+    with open(config_path) as file:
+        config = json.load(file)
+    for name, stage in config['stages'].items():
+        if stage['tool'] not in TOOLS:
+            raise ValueError(f'Stage "{name}" has unknown tool "{stage["tool"]}", expected one of {", ".join(TOOLS)}.')
+        for dependency in stage.get('after', []):
+            if dependency not in config['stages']:
+                raise ValueError(f'Stage "{name}" runs after "{dependency}", which is not a stage.')
+    return config
+
+def stage_paths(stage):
+    # absolute input and output paths of a stage, unset params (e.g. no columnar_dir) are left out
+    _, inputs, outputs, _ = TOOLS[stage['tool']]
+    params = stage['params']
+    return ([os.path.abspath(params[key]) for key in inputs if params.get(key) is not None],
+            [os.path.abspath(params[key]) for key in outputs if params.get(key) is not None])
+
+def dependencies(config):
+    # {stage: set of stages it waits for}, only earlier stages can be waited for so there are no cycles
+    names = list(config['stages'])
+    depends = {}
+    for index, name in enumerate(names):
+        inputs, outputs = stage_paths(config['stages'][name])
+        touched = set(inputs) | set(outputs)
+        depends[name] = set(config['stages'][name].get('after', []))
+        for earlier in names[:index]:
+            if touched & set(stage_paths(config['stages'][earlier])[1]):
+                depends[name].add(earlier)
+        later = [dependency for dependency in depends[name] if names.index(dependency) >= index]
+        if later:
+            raise ValueError(f'Stage "{name}" runs after "{later[0]}", which comes later in the config.')
+    return depends
+
+def written_paths(config):
+    # every path a stage writes, also the ones that are not params (voc2coco's manifest). they are left out of the
+    # fingerprint of a folder they are in, heridal's coco json is written into the image folder voc2coco reads
+    paths = set()
+    for stage in config['stages'].values():
+        paths.update(stage_paths(stage)[1])
+        if stage['tool'] == 'voc2coco' and stage['params'].get('incremental'):
+            paths.add(os.path.abspath(manifest_path(stage['params']['output_filename'])))
+    return paths
+
+def path_fingerprint(path, exclude = frozenset(), extensions = None):
+    # [size, mtime] of a file, a hash of the names, sizes and mtimes of everything under a folder (apart from the
+    # paths in exclude and temporary files, only the files ending in extensions when given), None if missing
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha1()
+    for folder, subfolders, files in os.walk(path):
+        subfolders[:] = sorted(subfolder for subfolder in subfolders if os.path.join(folder, subfolder) not in exclude)
+        for file in sorted(files):
+            if os.path.join(folder, file) in exclude or file.endswith('.tmp'):
+                continue
+            if extensions is not None and not file.lower().endswith(extensions):
+                continue
+            stat = os.stat(os.path.join(folder, file))
+            digest.update(f'{os.path.relpath(os.path.join(folder, file), path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def input_fingerprints(stage, exclude):
+    # {input path: fingerprint} of a stage, a folder only with the files the tool reads from it
+    _, inputs, _, files = TOOLS[stage['tool']]
+    params = stage['params']
+    fingerprints = {}
+    for key in inputs:
+        if params.get(key) is None:
+            continue
+        extensions = files.get(key)
+        if isinstance(extensions, str):
+            extensions = (params.get(extensions) or '',)
+        if extensions is not None:
+            extensions = tuple(extension.lower() for extension in extensions)
+        path = os.path.abspath(params[key])
+        fingerprints[path] = path_fingerprint(path, exclude, extensions)
+    return fingerprints
+
+def stage_key(stage):
+    return hashlib.sha1(json.dumps([stage['tool'], stage['params']], sort_keys = True).encode('utf-8')).hexdigest()
+
+def state_path(config_path):
+    return os.path.splitext(config_path)[0] + '.state.json'
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {'stages': {}, 'paths': {}}
+    with open(path) as file:
+        return json.load(file)
+
+def save_state(path, state):
+    # written after every stage, a crash keeps the stages that finished
+    handle, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.tmp')
+    with os.fdopen(handle, 'w') as file:
+        json.dump(state, file, indent = 4)
+    os.replace(temp_path, path)
+
+def why_stale(stage, record, state, exclude):
+    # the reason a stage has to run, None if its last run is still valid
+    if record is None:
+        return 'never ran'
+    if record['key'] != stage_key(stage):
+        return 'params changed'
+    _, outputs = stage_paths(stage)
+    for path in outputs:
+        fingerprint = path_fingerprint(path)
+        if fingerprint is None:
+            return f'"{path}" is missing'
+        # the last state the pipeline left the path in (a later stage may rewrite it in place, like prune)
+        if fingerprint != state['paths'].get(path):
+            return f'"{path}" changed outside the pipeline'
+    for path, fingerprint in input_fingerprints(stage, exclude).items():
+        if path not in outputs and fingerprint != record['inputs'].get(path):
+            return f'"{path}" changed'
+    return None
+
+def plan(config, state, depends, force = ()):
+    # {stage: reason} of the stages that will run, in config order. a stage whose dependency runs runs as well
+    exclude = written_paths(config)
+    stale = {}
+    for name, stage in config['stages'].items():
+        reason = 'forced' if name in force else why_stale(stage, state['stages'].get(name), state, exclude)
+        if reason is None:
+            rerun = sorted(dependency for dependency in depends[name] if dependency in stale)
+            reason = f'"{rerun[0]}" runs again' if rerun else None
+        if reason is not None:
+            stale[name] = reason
+    return stale
+
+def run_stage(tool, params):
+    # runs in a worker process
+    function = TOOLS[tool][0]
+    function(**params)
+
+def run_pipeline(config_path, force = (), workers = 4, dry_run = False):
+    # returns {stage: 'skipped' / 'done' / 'failed' / 'blocked'}
+    config = load_config(config_path)
+    depends = dependencies(config)
+    path = state_path(config_path)
+    state = load_state(path)
+    unknown = [name for name in force if name not in config['stages']]
+    if unknown:
+        raise ValueError(f'Cannot force "{unknown[0]}", it is not a stage.')
+
+    stale = plan(config, state, depends, force)
+    exclude = written_paths(config)
+    status = {name: 'skipped' for name in config['stages'] if name not in stale}
+    for name in config['stages']:
+        print(f'{name:32s} {"run: " + stale[name] if name in stale else "up to date"}')
+    if dry_run or not stale:
+        return status
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        running = {}
+        started = {}
+        while len(status) < len(config['stages']):
+            for name in stale:
+                if name in status or name in running.values():
+                    continue
+                if any(status.get(dependency) in ('failed', 'blocked') for dependency in depends[name]):
+                    status[name] = 'blocked'
+                    print(f'Stage "{name}" not run, a stage it depends on failed.')
+                elif all(status.get(dependency) in ('skipped', 'done') for dependency in depends[name]):
+                    stage = config['stages'][name]
+                    # fingerprints of the inputs as the stage sees them
+                    started[name] = input_fingerprints(stage, exclude)
+                    print(f'Running "{name}" ({stage["tool"]}).')
+                    running[executor.submit(run_stage, stage['tool'], stage['params'])] = name
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stage = config['stages'][name]
+                if future.exception() is not None:
+                    status[name] = 'failed'
+                    state['stages'].pop(name, None)
+                    print(f'Stage "{name}" failed: {future.exception()!r}')
+                else:
+                    status[name] = 'done'
+                    state['stages'][name] = {'key': stage_key(stage), 'inputs': started[name]}
+                    for output_path in stage_paths(stage)[1]:
+                        state['paths'][output_path] = path_fingerprint(output_path)
+                save_state(path, state)
+
+    counts = {value: list(status.values()).count(value) for value in ('done', 'skipped', 'failed', 'blocked')}
+    print(f'Pipeline finished: {counts["done"]} stages run, {counts["skipped"]} up to date, {counts["failed"]} failed, '
+          f'{counts["blocked"]} not run.')
+    return status
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run the dataset pipeline described by a json config.')
+    parser.add_argument('config', help = 'pipeline config, e.g. pipeline.json')
+    parser.add_argument('--force', nargs = '*', default = [], help = 'stages to run even if they are up to date')
+    parser.add_argument('--workers', type = int, default = 4, help = 'stages run at the same time')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'only show which stages would run')
+    args = parser.parse_args(argv)
+    status = run_pipeline(args.config, args.force, args.workers, args.dry_run)
+    return 1 if any(value in ('failed', 'blocked') for value in status.values()) else 0
+
+# guarded so the worker processes (spawned on windows) can import this module without running the pipeline
+if __name__ == '__main__':
+    sys.exit(main())
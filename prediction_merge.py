@@ -0,0 +1,142 @@
+import numpy as np
+
+# merge the predictions of overlapping slices back into one set of boxes per image, same options as sahi's
+# postprocess: GREEDYNMM (sahi's default for predict), NMM or NMS, matched by IOU or IOS (intersection over smaller area),
+# per category or class agnostic. boxes are n x 4 xyxy arrays in full image coordinates.
+# instead of comparing every box with every other one, boxes are put in a uniform grid and only boxes that share
+# a cell are compared, all of those pairs in one vectorized step
+
+def match_scores(boxes_a, boxes_b, metric = 'IOS'):
+    # IOU or IOS of boxes_a[i] against boxes_b[i] (or one box against many, through broadcasting)
+    x1 = np.maximum(boxes_a[..., 0], boxes_b[..., 0])
+    y1 = np.maximum(boxes_a[..., 1], boxes_b[..., 1])
+    x2 = np.minimum(boxes_a[..., 2], boxes_b[..., 2])
+    y2 = np.minimum(boxes_a[..., 3], boxes_b[..., 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    if metric == 'IOU':
+        union = area_a + area_b - intersection
+    else:
+        union = np.minimum(area_a, area_b)
+    return intersection / np.maximum(union, 1e-9)
+
+def grid_candidate_pairs(boxes, cell_size = None):
+    # every pair (i < j) of boxes that touch a common grid cell, only those can overlap
+    n = len(boxes)
+    if n < 2:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    if cell_size is None:
+        # about twice the typical box, so most boxes fall in 1 - 4 cells
+        cell_size = max(2 * float(np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))), 1.0)
+
+    cells = np.floor(boxes / cell_size).astype(np.int64)
+    cells -= np.tile(cells[:, :2].min(axis = 0), 2)
+    span_x = cells[:, 2] - cells[:, 0] + 1
+    span_y = cells[:, 3] - cells[:, 1] + 1
+    grid_width = int(cells[:, 2].max()) + 1
+
+    # one (cell, box) entry for every cell a box covers
+    counts = span_x * span_y
+    box_ids = np.repeat(np.arange(n), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = cells[box_ids, 0] + local % span_x[box_ids]
+    cell_y = cells[box_ids, 1] + local // span_x[box_ids]
+    cell_ids = cell_y * grid_width + cell_x
+
+    # sort by cell and pair every entry with every entry of the same cell
+    order = np.argsort(cell_ids, kind = 'stable')
+    cell_ids = cell_ids[order]
+    box_ids = box_ids[order]
+    starts = np.flatnonzero(np.r_[True, cell_ids[1:] != cell_ids[:-1]])
+    sizes = np.diff(np.r_[starts, len(cell_ids)])
+    entry_size = np.repeat(sizes, sizes)
+    entry_start = np.repeat(starts, sizes)
+
+    left = np.repeat(box_ids, entry_size)
+    offsets = np.arange(entry_size.sum()) - np.repeat(np.cumsum(entry_size) - entry_size, entry_size)
+    right = box_ids[np.repeat(entry_start, entry_size) + offsets]
+
+    keep = left < right
+    pairs = np.unique(left[keep] * n + right[keep])
+    return pairs // n, pairs % n
+
+def all_pairs(boxes):
+    return np.triu_indices(len(boxes), k = 1)
+
+def match_graph(boxes, categories, metric, threshold, class_agnostic, strict, use_grid = True, cell_size = None):
+    # adjacency lists (csr) of boxes that match each other
+    n = len(boxes)
+    left, right = grid_candidate_pairs(boxes, cell_size) if use_grid else all_pairs(boxes)
+    if not class_agnostic:
+        same = categories[left] == categories[right]
+        left, right = left[same], right[same]
+
+    values = match_scores(boxes[left], boxes[right], metric)
+    matched = values > threshold if strict else values >= threshold
+    left, right = left[matched], right[matched]
+
+    sources = np.concatenate([left, right])
+    targets = np.concatenate([right, left])
+    order = np.argsort(sources, kind = 'stable')
+    indptr = np.r_[0, np.cumsum(np.bincount(sources, minlength = n))]
+    return indptr, targets[order]
+
+def cluster_predictions(scores, indptr, neighbors, postprocess = 'GREEDYNMM'):
+    # {kept index: [merged indices]} walking the boxes from the highest score down, like sahi's nms / greedy_nmm / nmm
+    order = np.argsort(-scores, kind = 'stable')
+    rank = np.empty(len(scores), dtype = np.int64)
+    rank[order] = np.arange(len(scores))
+
+    assigned = np.full(len(scores), -1, dtype = np.int64)
+    clusters = {}
+    for index in order.tolist():
+        candidates = neighbors[indptr[index]:indptr[index + 1]]
+        candidates = candidates[rank[candidates] > rank[index]]
+        # highest score first, the order sahi merges them in
+        candidates = candidates[np.argsort(rank[candidates], kind = 'stable')]
+
+        if postprocess == 'NMM':
+            # nmm is transitive, whatever matches a merged box joins the cluster that box was merged into
+            keep = index if assigned[index] == -1 else int(assigned[index])
+            if keep == index:
+                clusters[index] = []
+                assigned[index] = index
+            candidates = candidates[assigned[candidates] == -1]
+            assigned[candidates] = keep
+            clusters[keep].extend(candidates.tolist())
+            continue
+
+        # nms / greedy nmm: a box that was already suppressed or merged is done
+        if assigned[index] != -1:
+            continue
+        assigned[index] = index
+        candidates = candidates[assigned[candidates] == -1]
+        assigned[candidates] = index
+        clusters[index] = candidates.tolist()
+    return clusters
+
+def merge_predictions(boxes, scores, categories, postprocess = 'GREEDYNMM', metric = 'IOS', threshold = 0.5,
+                      class_agnostic = False, use_grid = True, cell_size = None):
+    boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype = np.float64).reshape(-1)
+    categories = np.asarray(categories, dtype = np.int64).reshape(-1)
+
+    # sahi's nmm matches with a strict > threshold, nms and greedy nmm with >=
+    indptr, neighbors = match_graph(boxes, categories, metric, threshold, class_agnostic,
+                                    postprocess == 'NMM', use_grid, cell_size)
+    clusters = cluster_predictions(scores, indptr, neighbors, postprocess)
+
+    keeps = np.array(list(clusters.keys()), dtype = np.int64)
+    merged_boxes = boxes[keeps].copy()
+    if postprocess != 'NMS':
+        for row, (keep, merged) in enumerate(clusters.items()):
+            box = merged_boxes[row]
+            for index in merged:
+                # like sahi (has_match), a box is only merged if it still matches the growing merged box, strictly
+                if match_scores(box, boxes[index], metric) > threshold:
+                    box[:2] = np.minimum(box[:2], boxes[index, :2])
+                    box[2:] = np.maximum(box[2:], boxes[index, 2:])
+
+    return merged_boxes.reshape(-1, 4), scores[keeps], categories[keeps]
@@ -0,0 +1,127 @@
+import os
+import json
+
+import numpy as np
+
+# compact container for sahi result.json predictions: the boxes are sorted by image and stored as arrays
+# (bbox, score, category_id, area) with the start of every image in offsets.npy, so the predictions of one
+# image are two lookups into memory-mapped files. category names and the fields that are the same for every
+# detection (segmentation, iscrowd) go in meta.json once instead of in every entry.
+# scores are float32 in sahi, the boxes are float32 too unless that would change a value (sahi shifts slice
+# boxes in float64), then they stay float64 so converting back gives the same result.json. area is int64 when
+# every area is an int (sahi's), float64 otherwise, with area_is_int.npy marking the ints of a mixed list
+
+ARRAYS = ('image_ids', 'offsets', 'bbox', 'score', 'category_id', 'area')
+
+def smallest_exact(values, dtype = np.float32):
+    # values as float32 if that is lossless, float64 otherwise
+    small = values.astype(dtype)
+    return small if np.array_equal(small.astype(values.dtype), values) else values
+
+def save_predictions(path, results, score_floor = None, lossless = True):
+    # results is a result.json list, score_floor drops every detection below that score
+    if score_floor is not None:
+        results = [result for result in results if result['score'] >= score_floor]
+
+    constant = {}
+    for key in ('segmentation', 'iscrowd'):
+        values = {json.dumps(result.get(key)) for result in results}
+        if len(values) > 1:
+            raise ValueError(f'Field "{key}" differs between detections, only sahi bbox results can be stored.')
+        constant[key] = json.loads(values.pop()) if values else None
+
+    image_ids = np.array([result['image_id'] for result in results], dtype = np.int64)
+    # stable, so the detections of an image keep their order (highest score first in sahi's output)
+    order = np.argsort(image_ids, kind = 'stable')
+    bbox = np.array([result['bbox'] for result in results], dtype = np.float64).reshape(-1, 4)[order]
+    score = np.array([result['score'] for result in results], dtype = np.float64)[order]
+    arrays = {
+        'bbox': smallest_exact(bbox) if lossless else bbox.astype(np.float32),
+        'score': smallest_exact(score) if lossless else score.astype(np.float32),
+        'category_id': np.array([result['category_id'] for result in results], dtype = np.int32)[order],
+    }
+    areas = [result['area'] for result in results]
+    is_int = np.array([type(area) is int for area in areas], dtype = bool)[order]
+    if is_int.all():
+        arrays['area'] = np.array(areas, dtype = np.int64)[order]
+    else:
+        arrays['area'] = np.array(areas, dtype = np.float64)[order]
+        if is_int.any():
+            arrays['area_is_int'] = is_int
+    arrays['image_ids'], starts = np.unique(image_ids[order], return_index = True)
+    arrays['offsets'] = np.r_[starts, len(order)].astype(np.int64)
+
+    meta = {'version': 1, 'count': len(results), 'score_floor': score_floor, 'constant': constant,
+            'categories': {str(result['category_id']): result.get('category_name', '') for result in results},
+            # only needed to give back the original order when the results were not grouped by image
+            'sorted': bool(np.all(order == np.arange(len(order)))), 'area_is_int': 'area_is_int' in arrays}
+    if not meta['sorted']:
+        arrays['order'] = order.astype(np.int64)
+
+    os.makedirs(path, exist_ok = True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    # meta.json goes last, like coco_columnar
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+def load_predictions_store(path, mmap_mode = 'r'):
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    names = ARRAYS + (() if meta['sorted'] else ('order',)) + (('area_is_int',) if meta.get('area_is_int') else ())
+    store = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode = mmap_mode) for name in names}
+    store['meta'] = meta
+    return store
+
+def image_predictions(store, image_id):
+    # (bbox xywh, score, category_id) of one image, empty arrays if it has no detections
+    image_ids = store['image_ids']
+    index = int(np.searchsorted(image_ids, image_id))
+    if index == len(image_ids) or image_ids[index] != image_id:
+        start = end = 0
+    else:
+        start, end = int(store['offsets'][index]), int(store['offsets'][index + 1])
+    return store['bbox'][start:end], store['score'][start:end], store['category_id'][start:end]
+
+def store_to_results(store):
+    # the result.json list back, in the original order
+    meta = store['meta']
+    counts = np.diff(store['offsets'])
+    image_ids = np.repeat(np.asarray(store['image_ids']), counts).tolist()
+    bbox = np.asarray(store['bbox'], dtype = np.float64).tolist()
+    score = np.asarray(store['score'], dtype = np.float64).tolist()
+    category_id = np.asarray(store['category_id']).tolist()
+    area = np.asarray(store['area']).tolist()
+    if 'area_is_int' in store:
+        for index in np.flatnonzero(store['area_is_int']).tolist():
+            area[index] = int(area[index])
+
+    segmentation = meta['constant']['segmentation']
+    results = [None] * meta['count']
+    positions = range(meta['count']) if meta['sorted'] else np.asarray(store['order']).tolist()
+    for index, position in enumerate(positions):
+        results[position] = {
+            'image_id': image_ids[index],
+            'bbox': bbox[index],
+            'score': score[index],
+            'category_id': category_id[index],
+            'category_name': meta['categories'][str(category_id[index])],
+            # a new list for every detection, like json.load would give
+            'segmentation': list(segmentation) if isinstance(segmentation, list) else segmentation,
+            'iscrowd': meta['constant']['iscrowd'],
+            'area': area[index]
+        }
+    return results
+
+def json_to_store(result_path, store_path, score_floor = None, lossless = True):
+    with open(result_path) as file:
+        save_predictions(store_path, json.load(file), score_floor, lossless)
+
+def store_to_json(store_path, result_path):
+    # same separators as sahi's result.json
+    with open(result_path, 'w') as file:
+        json.dump(store_to_results(load_predictions_store(store_path)), file, separators = (',', ':'))
+
+if __name__ == '__main__':
+    json_to_store('./runs/yolov8n_100e_0p_16b_auto_320_12/sahi/320_12/result.json',
+                  './runs/yolov8n_100e_0p_16b_auto_320_12/sahi/320_12/result_store')
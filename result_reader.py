@@ -0,0 +1,135 @@
+import json
+
+import numpy as np
+
+# reads a coco result json (a list of detections, like sahi's result.json) without json.load-ing the whole
+# list: the file is parsed a chunk at a time and the detections come out one image at a time as numpy arrays.
+# sahi writes the detections grouped by image, so one pass is enough. for files that are not grouped, one pass
+# records where every detection is in the file (offset, length, image id) and the images are then read by seeking
+
+CHUNK_SIZE = 1 << 20
+
+def byte_length(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def iter_detections(path, chunk_size = CHUNK_SIZE):
+    # (byte offset, byte length, detection dict) of every entry of the top level list
+    decoder = json.JSONDecoder()
+    # newline = '' keeps \r\n as it is in the file (windows), otherwise the offsets would not match the bytes
+    with open(path, encoding = 'utf-8', newline = '') as file:
+        buffer = file.read(chunk_size)
+        eof = not buffer
+        position = 0
+        # byte offset of buffer[position] in the file
+        offset = 0
+        started = False
+        while True:
+            # skip whitespace, the opening bracket and the commas between entries
+            skip_start = position
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                if buffer[position] == '[':
+                    if started:
+                        raise ValueError(f'"{path}" is not a list of detections.')
+                    started = True
+                position += 1
+            offset += byte_length(buffer[skip_start:position])
+
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    # entries are objects, so this only succeeds once the whole entry is in the buffer
+                    detection, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    length = byte_length(buffer[position:end])
+                    yield offset, length, detection
+                    offset += length
+                    position = end
+                    continue
+            elif eof:
+                if started:
+                    raise ValueError(f'"{path}" ends before the list is closed.')
+                return
+
+            # not a whole entry left in the buffer, keep the rest and read the next chunk
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+
+def detections_to_arrays(detections):
+    bbox = np.array([detection['bbox'] for detection in detections], dtype = np.float64).reshape(-1, 4)
+    scores = np.array([detection['score'] for detection in detections], dtype = np.float64)
+    categories = np.array([detection['category_id'] for detection in detections], dtype = np.int64)
+    return bbox, scores, categories
+
+def index_result_file(path, chunk_size = CHUNK_SIZE):
+    # offsets, lengths and image ids of every detection, and whether each image's detections are contiguous
+    offsets, lengths, image_ids = [], [], []
+    for offset, length, detection in iter_detections(path, chunk_size):
+        offsets.append(offset)
+        lengths.append(length)
+        image_ids.append(detection['image_id'])
+    offsets = np.array(offsets, dtype = np.int64)
+    lengths = np.array(lengths, dtype = np.int64)
+    image_ids = np.array(image_ids, dtype = np.int64)
+
+    changes = np.count_nonzero(image_ids[1:] != image_ids[:-1])
+    grouped = len(image_ids) == 0 or changes + 1 == len(np.unique(image_ids))
+    return {'offsets': offsets, 'lengths': lengths, 'image_ids': image_ids, 'grouped': grouped}
+
+def iter_grouped(path, category_names, chunk_size):
+    current = None
+    detections = []
+    done = set()
+    for _, _, detection in iter_detections(path, chunk_size):
+        if detection['image_id'] != current:
+            if detections:
+                yield (current,) + detections_to_arrays(detections)
+                done.add(current)
+            current = detection['image_id']
+            if current in done:
+                raise ValueError(f'"{path}" is not grouped by image (image {current} appears twice), '
+                                 'read it with assume_grouped = False.')
+            detections = []
+        detections.append(detection)
+        if category_names is not None:
+            category_names.setdefault(detection['category_id'], detection.get('category_name', ''))
+    if detections:
+        yield (current,) + detections_to_arrays(detections)
+
+def iter_indexed(path, index, category_names):
+    # reads the detections of one image at a time, runs of neighbouring detections in one read
+    order = np.argsort(index['image_ids'], kind = 'stable')
+    image_ids = index['image_ids'][order]
+    starts = np.flatnonzero(np.r_[True, image_ids[1:] != image_ids[:-1]])
+    with open(path, 'rb') as file:
+        for group in np.split(order, starts[1:]) if len(order) else []:
+            detections = []
+            # a new run wherever the next detection of this image is not the next entry in the file
+            breaks = np.flatnonzero(np.diff(group) != 1) + 1
+            for run in np.split(group, breaks):
+                start = index['offsets'][run[0]]
+                end = index['offsets'][run[-1]] + index['lengths'][run[-1]]
+                file.seek(start)
+                detections.extend(json.loads(b'[' + file.read(end - start) + b']'))
+            if category_names is not None:
+                for detection in detections:
+                    category_names.setdefault(detection['category_id'], detection.get('category_name', ''))
+            yield (int(index['image_ids'][group[0]]),) + detections_to_arrays(detections)
+
+def iter_image_batches(path, assume_grouped = True, category_names = None, chunk_size = CHUNK_SIZE):
+    # (image id, xywh boxes, scores, category ids) of every image with detections. with assume_grouped the file is
+    # read once and a ValueError is raised if it turns out not to be grouped by image, otherwise it is indexed first.
+    # category_names (a dict) is filled with the category names found in the file
+    if assume_grouped:
+        yield from iter_grouped(path, category_names, chunk_size)
+        return
+    index = index_result_file(path, chunk_size)
+    if index['grouped']:
+        yield from iter_grouped(path, category_names, chunk_size)
+    else:
+        yield from iter_indexed(path, index, category_names)
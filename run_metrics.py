@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import platform
+from contextlib import contextmanager
+
+# timers, counters and peak memory of one run of a tool (voc2coco, remove_unused_images, optimize_overlap, ...).
+# a run is a plain dict from start_metrics (or measured_run), the tools take it (or None, then nothing is measured)
+# and fill it with stage(metrics, 'parse') blocks and count(metrics, 'bad_xml'). finish_metrics appends the run as
+# one line to a json-lines file, so the runs of a tool over time can be compared when the datasets grow.
+# with profile_path the whole run also goes through cProfile (open the .prof with pstats or snakeviz)
+
+def peak_memory():
+    # (peak rss of this process, peak rss of the largest finished child process) in bytes, None where unknown
+    try:
+        import resource
+    except ImportError:
+        # windows, psutil is only needed there
+        try:
+            import psutil
+        except ImportError:
+            return None, None
+        return psutil.Process().memory_info().peak_wset, None
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+def start_metrics(tool, metrics_path = None, profile_path = None, **parameters):
+    # parameters are stored with the run (e.g. the input folder), they have to be json serializable
+    metrics = {'tool': tool, 'started': time.time(), 'start': time.perf_counter(), 'parameters': parameters,
+               'stages': {}, 'counters': {}, 'metrics_path': metrics_path, 'profile_path': profile_path, 'profiler': None,
+               'record': None}
+    if profile_path is not None:
+        metrics['profiler'] = cProfile.Profile()
+        metrics['profiler'].enable()
+    return metrics
+
+def add_time(metrics, name, seconds):
+    if metrics is None:
+        return
+    timing = metrics['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0, 'process_peak_rss_bytes': None})
+    timing['seconds'] += seconds
+    timing['calls'] += 1
+    # the peak of the whole process up to the end of the stage, not the stage's own. the stage that raised it is
+    # the first one where it jumps
+    timing['process_peak_rss_bytes'] = peak_memory()[0]
+
+@contextmanager
+def stage(metrics, name):
+    # the time spent inside the block is added to the stage, a stage can be entered several times
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(metrics, name, time.perf_counter() - start)
+
+def count(metrics, name, amount = 1):
+    if metrics is not None:
+        metrics['counters'][name] = metrics['counters'].get(name, 0) + amount
+
+def finish_metrics(metrics, error = None):
+    # the run record (also appended to metrics_path when given), with status 'failed' when error is given.
+    # a run is only recorded once, finishing it again returns the same record
+    if metrics['record'] is not None:
+        return metrics['record']
+    if metrics['profiler'] is not None:
+        metrics['profiler'].disable()
+        os.makedirs(os.path.dirname(os.path.abspath(metrics['profile_path'])), exist_ok = True)
+        metrics['profiler'].dump_stats(metrics['profile_path'])
+
+    peak, peak_children = peak_memory()
+    record = {
+        'tool': metrics['tool'],
+        'status': 'ok' if error is None else 'failed',
+        'error': None if error is None else repr(error),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(metrics['started'])),
+        'wall_s': time.perf_counter() - metrics['start'],
+        'parameters': metrics['parameters'],
+        'stages': metrics['stages'],
+        'counters': metrics['counters'],
+        'peak_rss_bytes': peak,
+        'peak_child_rss_bytes': peak_children,
+        'python': platform.python_version(),
+        'profile_path': metrics['profile_path']
+    }
+    if metrics['metrics_path'] is not None:
+        with open(metrics['metrics_path'], 'a') as file:
+            file.write(json.dumps(record) + '\n')
+    metrics['record'] = record
+    return record
+
+@contextmanager
+def measured_run(tool, metrics_path = None, profile_path = None, **parameters):
+    # start_metrics and finish_metrics around a block: the profiler is always stopped and a run that raises is
+    # recorded too, as failed. the block can finish the run itself to get the record
+    metrics = start_metrics(tool, metrics_path, profile_path, **parameters)
+    try:
+        yield metrics
+    except BaseException as error:
+        finish_metrics(metrics, error)
+        raise
+    finish_metrics(metrics)
+
+def load_metrics(metrics_path, tool = None):
+    # every run recorded in a json-lines file, optionally only one tool's
+    with open(metrics_path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return [record for record in records if tool is None or record['tool'] == tool]
+
+def compare_runs(metrics_path, tool, last = 2):
+    # seconds of every stage in the last runs of a tool, to spot a stage that got slower
+    records = load_metrics(metrics_path, tool)[-last:]
+    names = sorted({name for record in records for name in record['stages']})
+    print(f'{"stage":>12} ' + ' '.join(f'{record["started"]:>20}' for record in records))
+    for name in names + ['wall']:
+        seconds = [record['wall_s'] if name == 'wall' else record['stages'].get(name, {}).get('seconds') for record in records]
+        print(f'{name:>12} ' + ' '.join(f'{value:>19.3f}s' if value is not None else f'{"-":>20}' for value in seconds))
+    return records
+
+if __name__ == '__main__':
+    compare_runs('metrics.jsonl', 'voc2coco')
@@ -0,0 +1,264 @@
+import os
+import glob
+import json
+import struct
+
+import numpy as np
+
+from batch_evaluate import parse_run_name
+from sahi_logs import parse_slice_config
+
+# one index over every runs/<run>/training/<train dir>: the normalized config (args.yaml, run folder name and
+# dataset folder combined), every epoch of results.csv and the epoch end times from the tensorboard events file.
+# the index is stored as columns (like coco_columnar) with runs.json next to it, and only runs whose files
+# changed since the last refresh are parsed again
+
+EPOCH_METRIC = 'mAP50-95'
+
+def parse_args_yaml(path):
+    # ultralytics args.yaml is flat "key: value" lines, no need for a yaml parser
+    args = {}
+    with open(path) as file:
+        for line in file:
+            key, sep, value = line.rstrip('\n').partition(': ')
+            if not sep:
+                continue
+            value = value.strip()
+            if value in ('null', ''):
+                args[key] = None
+            elif value in ('true', 'false'):
+                args[key] = value == 'true'
+            else:
+                try:
+                    args[key] = int(value)
+                except ValueError:
+                    try:
+                        args[key] = float(value)
+                    except ValueError:
+                        args[key] = value
+    return args
+
+def column_name(header):
+    # "metrics/mAP50-95(B)" -> "mAP50-95", "train/box_loss" -> "train_box_loss", usable as a file name
+    return header.strip().replace('metrics/', '').replace('(B)', '').replace('/', '_')
+
+def parse_results_csv(path):
+    # results.csv columns are padded with spaces to a fixed width
+    data = np.loadtxt(path, delimiter = ',', skiprows = 1, ndmin = 2)
+    with open(path) as file:
+        headers = [column_name(header) for header in file.readline().split(',')]
+    return {header: data[:, index] for index, header in enumerate(headers)}
+
+def iter_fields(buffer):
+    # (field number, value) of a serialized protobuf message, only the wire types the event files use
+    position = 0
+    while position < len(buffer):
+        key, position = read_varint(buffer, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(buffer, position)
+        elif wire_type == 1:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wire_type == 2:
+            length, position = read_varint(buffer, position)
+            value = buffer[position:position + length]
+            position += length
+        elif wire_type == 5:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}.')
+        yield field, value
+
+def read_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+def read_scalar_events(path):
+    # (tag, step, wall time, value) of every scalar in a tensorboard events file, read without tensorflow.
+    # the file is a sequence of records: 8 byte length, 4 byte crc, the serialized Event, 4 byte crc.
+    # files copied while training was still writing can end in a cut off record, which is ignored
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    events = []
+    position = 0
+    while position + 12 <= len(data):
+        length = struct.unpack_from('<Q', data, position)[0]
+        if position + 16 + length > len(data):
+            break
+        record = data[position + 12:position + 12 + length]
+        position += 12 + length + 4
+
+        wall_time, step, summary = 0.0, 0, None
+        for field, value in iter_fields(record):
+            if field == 1:
+                wall_time = struct.unpack('<d', value)[0]
+            elif field == 2:
+                step = value
+            elif field == 5:
+                summary = value
+        if summary is None:
+            continue
+        for field, value in iter_fields(summary):
+            if field != 1:
+                continue
+            tag, scalar = None, None
+            for value_field, content in iter_fields(value):
+                if value_field == 1:
+                    tag = content.decode('utf-8', errors = 'replace')
+                elif value_field == 2:
+                    scalar = struct.unpack('<f', content)[0]
+            if scalar is not None:
+                events.append((tag, step, wall_time, scalar))
+    return events
+
+def epoch_end_times(events_paths, epochs):
+    # wall time each epoch's validation metrics were first logged, the difference is the epoch duration.
+    # resumed runs have one events file per session, the final validation logs the last epoch again
+    end_times = np.full(epochs, np.nan)
+    for path in events_paths:
+        for tag, step, wall_time, _ in read_scalar_events(path):
+            if column_name(tag) == EPOCH_METRIC and 1 <= step <= epochs and np.isnan(end_times[step - 1]):
+                end_times[step - 1] = wall_time
+    return end_times
+
+def normalize_config(run, args):
+    # args.yaml is what was actually trained, the run folder name fills in what it does not say.
+    # the slice size and overlap of the training set come from the dataset folder (e.g. datasets/320_12)
+    from_name = parse_run_name(run)
+    config = {'run': run}
+    config['model'] = from_name['model'] or 'yolov8n'
+    config['epochs'] = args.get('epochs', from_name['epochs'])
+    config['patience'] = args.get('patience', from_name['patience'])
+    config['batch'] = args.get('batch', from_name['batch'])
+    # optimizer auto is resolved by ultralytics at train time, the folder name says what it picked
+    config['optimizer'] = args.get('optimizer') or from_name['optimizer']
+    if config['optimizer'] == 'auto' and from_name['optimizer'] not in (None, 'auto'):
+        config['optimizer'] = from_name['optimizer']
+    config['imgsz'] = args.get('imgsz')
+
+    dataset = os.path.basename(os.path.dirname(str(args.get('data', ''))))
+    try:
+        config['train_slice_size'], config['train_overlap'] = parse_slice_config(dataset)
+    except ValueError:
+        config['train_slice_size'], config['train_overlap'] = from_name['train_slice_size'], from_name['train_overlap']
+    # runs continued from a checkpoint have last.pt as the model
+    config['resumed'] = str(args.get('model', '')).endswith('last.pt')
+    return config
+
+def find_train_dirs(runs_dir = 'runs'):
+    return sorted(os.path.dirname(path) for path in glob.glob(os.path.join(runs_dir, '*', 'training', '*', 'args.yaml')))
+
+def train_dir_files(train_dir):
+    files = {'args': os.path.join(train_dir, 'args.yaml'), 'results': os.path.join(train_dir, 'results.csv')}
+    files = {key: path for key, path in files.items() if os.path.exists(path)}
+    for path in sorted(glob.glob(os.path.join(train_dir, 'events.out.tfevents.*'))):
+        files[os.path.basename(path)] = path
+    return files
+
+def fingerprint(files):
+    return {key: [os.path.getsize(path), os.stat(path).st_mtime_ns] for key, path in files.items()}
+
+def parse_train_dir(train_dir):
+    files = train_dir_files(train_dir)
+    run = os.path.basename(os.path.dirname(os.path.dirname(train_dir)))
+    record = {'path': train_dir, 'fingerprint': fingerprint(files),
+              'config': normalize_config(run, parse_args_yaml(files['args']))}
+
+    epochs = parse_results_csv(files['results']) if 'results' in files else {}
+    events_paths = [path for key, path in files.items() if key.startswith('events.')]
+    if epochs and events_paths:
+        end_times = epoch_end_times(events_paths, len(epochs['epoch']))
+        epochs['epoch_seconds'] = np.diff(end_times, prepend = np.nan)
+    return record, epochs
+
+def load_registry(index_dir = 'runs_index', mmap_mode = 'r'):
+    # {'runs': [run records], 'epochs': {column: array}}, epochs['run_index'] points into runs
+    meta_path = os.path.join(index_dir, 'runs.json')
+    if not os.path.exists(meta_path):
+        return {'runs': [], 'epochs': {}}
+    with open(meta_path) as file:
+        meta = json.load(file)
+    epochs = {column: np.load(os.path.join(index_dir, f'epochs.{column}.npy'), mmap_mode = mmap_mode) for column in meta['columns']}
+    return {'runs': meta['runs'], 'epochs': epochs}
+
+def save_registry(index_dir, runs, epoch_tables):
+    # epoch_tables has one {column: array} per run, runs without results.csv have an empty one
+    columns = []
+    for table in epoch_tables:
+        columns.extend(column for column in table if column not in columns)
+
+    os.makedirs(index_dir, exist_ok = True)
+    lengths = [len(next(iter(table.values()))) if table else 0 for table in epoch_tables]
+    np.save(os.path.join(index_dir, 'epochs.run_index.npy'), np.repeat(np.arange(len(runs)), lengths))
+    for column in columns:
+        values = [np.asarray(table[column], dtype = np.float64) if column in table else np.full(length, np.nan)
+                  for table, length in zip(epoch_tables, lengths)]
+        np.save(os.path.join(index_dir, f'epochs.{column}.npy'), np.concatenate(values) if values else np.zeros(0))
+
+    # runs.json goes last, like coco_columnar's meta.json
+    with open(os.path.join(index_dir, 'runs.json'), 'w') as file:
+        json.dump({'version': 1, 'runs': runs, 'columns': ['run_index'] + columns}, file, indent = 4)
+
+def refresh_registry(runs_dir = 'runs', index_dir = 'runs_index'):
+    old = load_registry(index_dir, mmap_mode = None)
+    old_runs = {record['path']: index for index, record in enumerate(old['runs'])}
+    run_index = old['epochs'].get('run_index')
+
+    runs = []
+    epoch_tables = []
+    parsed = 0
+    for train_dir in find_train_dirs(runs_dir):
+        index = old_runs.get(train_dir)
+        if index is not None and old['runs'][index]['fingerprint'] == fingerprint(train_dir_files(train_dir)):
+            # unchanged, reuse the rows already in the index
+            rows = run_index == index
+            runs.append(old['runs'][index])
+            epoch_tables.append({column: values[rows] for column, values in old['epochs'].items()
+                                 if column != 'run_index' and not np.isnan(values[rows]).all()} if rows.any() else {})
+            continue
+        record, epochs = parse_train_dir(train_dir)
+        runs.append(record)
+        epoch_tables.append(epochs)
+        parsed += 1
+
+    save_registry(index_dir, runs, epoch_tables)
+    print(f'{len(runs)} runs indexed, {parsed} parsed, {len(runs) - parsed} unchanged.')
+    return load_registry(index_dir)
+
+def query_runs(registry, **filters):
+    # indices of the runs whose config matches every filter, e.g. query_runs(registry, imgsz = 320, optimizer = 'SGD')
+    return [index for index, record in enumerate(registry['runs'])
+            if all(record['config'].get(key) == value for key, value in filters.items())]
+
+def best_epochs(registry, metric = EPOCH_METRIC, group_by = None, **filters):
+    # the best epoch (highest metric) of every matching run, or only the best run of every group_by value,
+    # e.g. best_epochs(registry, 'mAP50-95', group_by = 'optimizer', imgsz = 320)
+    epochs = registry['epochs']
+    if metric not in epochs:
+        return []
+    run_index = np.asarray(epochs['run_index'])
+    values = np.asarray(epochs[metric])
+    matching = np.flatnonzero(np.isin(run_index, query_runs(registry, **filters)) & ~np.isnan(values))
+
+    best = {}
+    for row in matching[np.argsort(-values[matching], kind = 'stable')].tolist():
+        config = registry['runs'][int(run_index[row])]['config']
+        key = config[group_by] if group_by else config['run']
+        if key not in best:
+            best[key] = {**config, 'epoch': int(epochs['epoch'][row]), metric: float(values[row])}
+    return list(best.values())
+
+if __name__ == '__main__':
+    registry = refresh_registry('runs', 'runs_index')
+    for row in best_epochs(registry, 'mAP50-95', group_by = 'optimizer', imgsz = 320):
+        print(row)
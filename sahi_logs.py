@@ -0,0 +1,60 @@
+import os
+import re
+import glob
+
+import numpy as np
+
+# the sahi predict output.txt files are tqdm progress bars with the sahi prints mixed in, e.g.
+# "...| 1/101 [00:05<09:37,  5.77s/it]Performing prediction on 165 number of slices."
+# "...| 1/101 [00:05<09:37,  5.77s/it]Prediction time is: 5322.25 ms"
+
+SLICES_PATTERN = re.compile(r'Performing prediction on (\d+) number of slices')
+TIME_PATTERN = re.compile(r'Prediction time is: ([\d.]+) ms')
+
+def parse_sahi_log(path):
+    # per image slice count and prediction time (ms), in the order the images were processed
+    with open(path, encoding = 'utf-8', errors = 'replace') as file:
+        text = file.read()
+    slices = [int(value) for value in SLICES_PATTERN.findall(text)]
+    times = [float(value) for value in TIME_PATTERN.findall(text)]
+
+    # a log cut off mid-image has one more slice line than time line
+    count = min(len(slices), len(times))
+    return np.array(slices[:count], dtype = np.int64), np.array(times[:count], dtype = np.float64)
+
+def parse_slice_config(name):
+    # sahi folder names are <slice size>_<overlap in percent>, e.g. 320_12 -> (320, 0.12)
+    size, overlap = name.split('_')
+    return int(size), int(overlap) / 100
+
+def find_sahi_logs(runs_dir = 'runs'):
+    return sorted(glob.glob(os.path.join(runs_dir, '*', 'sahi', '*', 'output.txt')))
+
+def latency_stats(slices, times, outlier_factor = 2.0):
+    # latency percentiles and throughput of one log, over every image. images slower than outlier_factor times
+    # the median are outliers (warm-up, like the 5.3 s first and last images in some logs), the warm_ figures
+    # are the same numbers without them
+    if len(times) == 0:
+        return {'images': 0}
+    outliers = times > outlier_factor * np.median(times)
+    kept = ~outliers
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]).tolist()
+    warm_p50, warm_p95, warm_p99 = np.percentile(times[kept], [50, 95, 99]).tolist()
+    return {
+        'images': len(times),
+        'slices_per_image': float(slices.mean()),
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'mean_ms': float(times.mean()),
+        'slices_per_s': float(slices.sum() / times.sum() * 1000),
+        'warm_p50_ms': warm_p50,
+        'warm_p95_ms': warm_p95,
+        'warm_p99_ms': warm_p99,
+        'warm_mean_ms': float(times[kept].mean()),
+        'warm_slices_per_s': float(slices[kept].sum() / times[kept].sum() * 1000),
+        'outliers': int(outliers.sum()),
+        'outlier_images': np.flatnonzero(outliers).tolist(),
+        'outlier_ms': times[outliers].tolist()
+    }
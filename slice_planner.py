@@ -0,0 +1,115 @@
+import numpy as np
+
+from slicer import get_slice_bboxes
+from coco_columnar import load_coco_columns
+from sahi_logs import parse_sahi_log, find_sahi_logs
+from optimal_overlap_calcu import overlap_table
+
+# estimate the cost (slices / latency) and coverage (objects that end up whole in at least one slice)
+# of every (slice size, overlap) candidate from the ground truth alone, before spending gpu time on a sahi run
+
+SLICE_SIZES = (320, 512, 640, 960, 1280)
+OVERLAPS = (0.03, 0.06, 0.07, 0.12, 0.15, 0.2, 0.3)
+
+def fit_latency_model(log_paths):
+    # prediction time ~ fixed cost + cost per slice, fitted over every image of every log.
+    # the first and last image of each log are the warm-up / tear-down outliers so they are left out
+    slices = []
+    times = []
+    for path in log_paths:
+        log_slices, log_times = parse_sahi_log(path)
+        slices.append(log_slices[1:-1])
+        times.append(log_times[1:-1])
+    slices = np.concatenate(slices)
+    times = np.concatenate(times)
+
+    per_slice_ms, fixed_ms = np.polyfit(slices, times, 1)
+    return fixed_ms, per_slice_ms
+
+def group_boxes_by_image(columns):
+    # xyxy boxes of every image, keyed by image id
+    annotations = columns['annotations']
+    if not annotations:
+        return {}
+    image_ids = np.asarray(annotations['image_id'])
+    bbox = np.asarray(annotations['bbox'], dtype = np.float64)
+    boxes = np.concatenate([bbox[:, :2], bbox[:, :2] + bbox[:, 2:]], axis = 1)
+
+    order = np.argsort(image_ids, kind = 'stable')
+    unique_ids, starts = np.unique(image_ids[order], return_index = True)
+    return {image_id: boxes[indices] for image_id, indices in zip(unique_ids.tolist(), np.split(order, starts[1:]))}
+
+def intact_objects(slices, boxes):
+    # number of boxes that fit completely inside at least one slice
+    inside = ((slices[:, None, 0] <= boxes[None, :, 0]) & (slices[:, None, 1] <= boxes[None, :, 1]) &
+              (slices[:, None, 2] >= boxes[None, :, 2]) & (slices[:, None, 3] >= boxes[None, :, 3]))
+    return int(inside.any(axis = 0).sum())
+
+def pareto_front(rows):
+    # cheapest first, a candidate is on the front if nothing cheaper (or as cheap) keeps more objects whole
+    front = []
+    best = -1
+    for row in sorted(rows, key = lambda row: (row['slices_per_image'], -row['intact_fraction'])):
+        if row['intact_fraction'] > best:
+            front.append(row)
+            best = row['intact_fraction']
+    return front
+
+def plan_slices(gt_source, slice_sizes = SLICE_SIZES, overlaps = OVERLAPS, log_paths = None):
+    columns = load_coco_columns(gt_source)
+    images = columns['images']
+    boxes_by_image = group_boxes_by_image(columns)
+    total_objects = sum(len(boxes) for boxes in boxes_by_image.values())
+
+    # images of the same size share the same grid
+    image_sizes = list(zip(np.asarray(images['id']).tolist(), np.asarray(images['height']).tolist(), np.asarray(images['width']).tolist()))
+
+    if log_paths is None:
+        log_paths = find_sahi_logs()
+    fixed_ms, per_slice_ms = fit_latency_model(log_paths) if log_paths else (np.nan, np.nan)
+
+    # the overlap needed for the largest object, to compare against the measured coverage
+    bbox = np.asarray(columns['annotations']['bbox']) if total_objects else np.zeros((1, 4))
+    needed = {row['crop_w']: row['overlap_w'] for row in overlap_table(bbox[:, 2], bbox[:, 3], slice_sizes, percentiles = ()) if row['statistic'] == 'max'}
+
+    rows = []
+    for slice_size in slice_sizes:
+        for overlap in overlaps:
+            grids = {}
+            total_slices = 0
+            intact = 0
+            for image_id, height, width in image_sizes:
+                if (height, width) not in grids:
+                    grids[(height, width)] = get_slice_bboxes(height, width, slice_size, overlap)
+                slices = grids[(height, width)]
+                total_slices += len(slices)
+                if image_id in boxes_by_image:
+                    intact += intact_objects(slices, boxes_by_image[image_id])
+
+            slices_per_image = total_slices / max(len(image_sizes), 1)
+            rows.append({
+                'slice_size': slice_size,
+                'overlap': overlap,
+                'slices_per_image': slices_per_image,
+                'total_slices': total_slices,
+                'intact_fraction': intact / total_objects if total_objects else 1.0,
+                'overlap_for_largest': needed[slice_size],
+                'est_latency_ms': fixed_ms + per_slice_ms * slices_per_image
+            })
+
+    front = pareto_front(rows)
+    front_ids = set(id(row) for row in front)
+    for row in rows:
+        row['pareto'] = id(row) in front_ids
+    return rows, front
+
+def print_plan(rows):
+    print(f"{'config':>8} {'slices/img':>10} {'intact':>7} {'largest ok':>10} {'est ms/img':>10}  pareto")
+    for row in rows:
+        print(f"{row['slice_size']:>4}_{round(row['overlap'] * 100):02d} {row['slices_per_image']:10.1f} "
+              f"{row['intact_fraction']:7.1%} {str(row['overlap'] >= row['overlap_for_largest']):>10} "
+              f"{row['est_latency_ms']:10.0f}  {'*' if row['pareto'] else ''}")
+
+if __name__ == '__main__':
+    rows, front = plan_slices('../heridal/testImages/coco_test_label.json')
+    print_plan(rows)
@@ -0,0 +1,349 @@
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from slicer import get_slice_bboxes, clip_boxes_to_slices
+from prediction_merge import merge_predictions
+from result_reader import iter_image_batches
+from coco_evaluator import load_ground_truth, load_predictions, evaluate_predictions, write_eval_json
+from image_cache import cached_decode, cache_report
+
+# sliced inference like sahi's predict, but the next images are decoded on background threads while the
+# current one is being inferred, and slices go through the model in batches instead of one by one.
+# writes the same result.json format as runs/*/sahi/*/result.json plus the time spent in every stage.
+# with coarse_to_fine the full image pass runs first and only the slices near something it found (even with a low
+# score) get full resolution inference, most heridal slices are only vegetation or rock
+
+STAGES = ('decode', 'coarse', 'slice', 'infer', 'merge')
+
+def decode_image(path):
+    start = time.perf_counter()
+    with Image.open(path) as image:
+        array = np.asarray(image.convert('RGB'))
+    return array, time.perf_counter() - start
+
+def yolo_predictor(weights, image_size = 640, conf = 0.25, device = 'cpu'):
+    # ultralytics is only needed when a real model is used
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+
+    def predict(crops):
+        # ultralytics takes numpy images as bgr (cv2 convention)
+        results = model.predict([np.ascontiguousarray(crop[..., ::-1]) for crop in crops],
+                                imgsz = image_size, conf = conf, device = device, verbose = False)
+        return [(result.boxes.xyxy.cpu().numpy(), result.boxes.conf.cpu().numpy(), result.boxes.cls.cpu().numpy().astype(np.int64))
+                for result in results]
+    return predict
+
+def select_slices(slices, boxes, scores, coarse_conf = 0.05, margin = 32, max_skip = 0.9):
+    # which slices get full resolution inference after the coarse pass: the ones overlapping a coarse box with a
+    # score >= coarse_conf (grown by margin pixels, the downscaled pass is not precise). at most max_skip of the
+    # slices are skipped, if more would be the slices with the best (lower) coarse scores are run as well
+    tile_scores = np.zeros(len(slices))
+    if len(boxes):
+        grown = boxes + np.array([-margin, -margin, margin, margin])
+        _, touches = clip_boxes_to_slices(slices, grown, 0)
+        tile_scores = np.where(touches, scores[None, :], 0).max(axis = 1)
+
+    keep = tile_scores >= max(coarse_conf, 1e-12)
+    must_run = len(slices) - int(np.floor(max_skip * len(slices)))
+    if keep.sum() < must_run:
+        order = np.argsort(-tile_scores, kind = 'stable')
+        keep[order[:must_run]] = True
+    return keep
+
+def predict_image(predict, image, slice_size, overlap, batch_size = 16, full_image_pred = True,
+                  postprocess = 'GREEDYNMM', match_metric = 'IOS', match_threshold = 0.5, class_agnostic = False,
+                  coarse_to_fine = False, coarse_predict = None, coarse_conf = 0.05, margin = 32, max_skip = 0.9,
+                  full_image_prediction = None):
+    # returns merged xyxy boxes, scores, categories and the time of each stage (decode is done by the caller),
+    # plus the number of slices and how many of them were run. coarse_predict is the predictor of the coarse pass
+    # (e.g. the same model with a lower conf, or a smaller one), predict by default. full_image_prediction is an
+    # already computed full image pass (xyxy, scores, categories) to use instead of running it again
+    timings = {'coarse': 0.0}
+    height, width = image.shape[:2]
+    slices = get_slice_bboxes(height, width, slice_size, overlap)
+    timings['slices'] = len(slices)
+
+    coarse = []
+    if coarse_to_fine:
+        # the coarse predictor's own confidence threshold has to be <= coarse_conf for the low score boxes to show up
+        start = time.perf_counter()
+        coarse = (coarse_predict or predict)([image])
+        boxes, scores, _ = coarse[0]
+        boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+        scores = np.asarray(scores, dtype = np.float64).reshape(-1)
+        slices = slices[select_slices(slices, boxes, scores, coarse_conf, margin, max_skip)]
+        timings['coarse'] = time.perf_counter() - start
+        if full_image_pred and coarse_predict is None:
+            # with the same predictor the coarse pass is sahi's full image prediction, no need to run it again
+            full_image_pred = False
+        else:
+            coarse = []
+    timings['slices_run'] = len(slices)
+
+    start = time.perf_counter()
+    slices = slices.tolist()
+    # crops are views into the decoded image, nothing is copied here
+    crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in slices]
+    offsets = [(x1, y1) for x1, y1, _, _ in slices]
+    if full_image_pred and full_image_prediction is None:
+        # sahi also runs the (downscaled) full image by default
+        crops.append(image)
+        offsets.append((0, 0))
+    timings['slice'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = []
+    for batch_start in range(0, len(crops), batch_size):
+        predictions.extend(predict(crops[batch_start:batch_start + batch_size]))
+    timings['infer'] = time.perf_counter() - start
+    if coarse:
+        predictions.extend(coarse)
+        offsets.append((0, 0))
+    if full_image_prediction is not None and full_image_pred:
+        predictions.append(full_image_prediction)
+        offsets.append((0, 0))
+
+    start = time.perf_counter()
+    boxes = [np.asarray(xyxy, dtype = np.float64).reshape(-1, 4) + [x, y, x, y] for (xyxy, _, _), (x, y) in zip(predictions, offsets)]
+    scores = [np.asarray(score, dtype = np.float64).reshape(-1) for _, score, _ in predictions]
+    categories = [np.asarray(category, dtype = np.int64).reshape(-1) for _, _, category in predictions]
+    # every slice can be skipped when there is no full image pass
+    merged = merge_predictions(np.concatenate([np.zeros((0, 4))] + boxes), np.concatenate([np.zeros(0)] + scores),
+                               np.concatenate([np.zeros(0, dtype = np.int64)] + categories),
+                               postprocess, match_metric, match_threshold, class_agnostic)
+    timings['merge'] = time.perf_counter() - start
+    return merged, timings
+
+def to_coco_results(image_id, boxes, scores, categories, category_names):
+    # same fields as sahi's result.json, highest score first
+    results = []
+    for index in np.argsort(-scores, kind = 'stable'):
+        x1, y1, x2, y2 = boxes[index].tolist()
+        results.append({
+            'image_id': image_id,
+            'bbox': [x1, y1, x2 - x1, y2 - y1],
+            'score': float(scores[index]),
+            'category_id': int(categories[index]),
+            'category_name': category_names.get(int(categories[index]), ''),
+            'segmentation': [],
+            'iscrowd': 0,
+            'area': int((x2 - x1) * (y2 - y1))
+        })
+    return results
+
+def summarize_timings(timings):
+    summary = {}
+    for stage in STAGES + ('total',):
+        values = np.array([timing[stage] for timing in timings]) * 1000
+        summary[stage] = {'mean_ms': float(values.mean()), 'p50_ms': float(np.percentile(values, 50)),
+                          'p95_ms': float(np.percentile(values, 95)), 'total_s': float(values.sum() / 1000)}
+    return summary
+
+def cached_decoder(image_cache):
+    # decode_image through an image_cache.open_image_cache cache, the lookups are counted in the cache
+    def decode(path):
+        array, _, seconds, _ = cached_decode(image_cache, path)
+        return array, seconds
+    return decode
+
+def iter_decoded(paths, decode_workers = 2, prefetch = 4, decode = decode_image):
+    # keeps up to prefetch images decoding in the background while the caller works on the current one.
+    # decode(path) returns (array, seconds), e.g. decode_image
+    with ThreadPoolExecutor(max_workers = decode_workers) as executor:
+        pending = deque()
+        paths = iter(paths)
+        for path in paths:
+            pending.append(executor.submit(decode, path))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(executor.submit(decode, next_path))
+            yield future.result()
+
+def run_sliced_inference(predict, gt_path, image_dir, output_path, slice_size = 320, overlap = 0.12,
+                         batch_size = 16, decode_workers = 2, prefetch = 4, full_image_pred = True,
+                         postprocess = 'GREEDYNMM', match_metric = 'IOS', match_threshold = 0.5, class_agnostic = False,
+                         coarse_to_fine = False, coarse_predict = None, coarse_conf = 0.05, margin = 32, max_skip = 0.9,
+                         image_cache = None):
+    # image ids and category names come from the ground truth json, like sahi predict(dataset_json_path = ...).
+    # image_cache (from image_cache.open_image_cache) keeps the decoded images for the next runs
+    with open(gt_path) as file:
+        gt = json.load(file)
+    category_names = {category['id']: category['name'] for category in gt['categories']}
+    images = gt['images']
+
+    results = []
+    timings = []
+    wall_start = time.perf_counter()
+    decode = decode_image if image_cache is None else cached_decoder(image_cache)
+    decoded = iter_decoded([os.path.join(image_dir, image['file_name']) for image in images], decode_workers, prefetch, decode)
+    for image, (array, decode_seconds) in zip(images, decoded):
+        start = time.perf_counter()
+        (boxes, scores, categories), timing = predict_image(predict, array, slice_size, overlap, batch_size, full_image_pred,
+                                                            postprocess, match_metric, match_threshold, class_agnostic,
+                                                            coarse_to_fine, coarse_predict, coarse_conf, margin, max_skip)
+        results.extend(to_coco_results(image['id'], boxes, scores, categories, category_names))
+
+        # decode time is measured on the worker thread, total is what the main loop actually spent (decode overlaps)
+        timing['decode'] = decode_seconds
+        timing['total'] = time.perf_counter() - start
+        timings.append(timing)
+
+    with open(output_path, 'w') as file:
+        json.dump(results, file, separators = (',', ':'))
+
+    slices = sum(timing['slices'] for timing in timings)
+    report = {'images': len(images), 'wall_s': time.perf_counter() - wall_start, 'batch_size': batch_size,
+              'slice_size': slice_size, 'overlap': overlap, 'coarse_to_fine': coarse_to_fine,
+              'skipped_fraction': 1 - sum(timing['slices_run'] for timing in timings) / slices if slices else 0.0,
+              'stages': summarize_timings(timings) if timings else {}}
+    if image_cache is not None:
+        report['image_cache'] = cache_report(image_cache)
+    with open(os.path.splitext(output_path)[0] + '_timings.json', 'w') as file:
+        json.dump({'summary': report, 'per_image': timings}, file, indent = 4)
+
+    print(f'Predicted {len(images)} images in {report["wall_s"]:.1f}s, {len(results)} detections written to "{output_path}".')
+    return report
+
+def compare_coarse_to_fine(predict, gt_path, image_dir, output_dir, slice_size = 320, overlap = 0.12, batch_size = 16,
+                           coarse_predict = None, coarse_conf = 0.05, margin = 32, max_skip = 0.9):
+    # runs the exhaustive and the coarse to fine inference and evaluates both against the ground truth,
+    # the recall lost is measured at the evaluator's count thresholds (iou 0.5 and 0.1)
+    os.makedirs(output_dir, exist_ok = True)
+    exhaustive_path = os.path.join(output_dir, 'result.json')
+    coarse_path = os.path.join(output_dir, 'result_coarse_to_fine.json')
+    exhaustive = run_sliced_inference(predict, gt_path, image_dir, exhaustive_path, slice_size, overlap, batch_size)
+    coarse = run_sliced_inference(predict, gt_path, image_dir, coarse_path, slice_size, overlap, batch_size,
+                                  coarse_to_fine = True, coarse_predict = coarse_predict, coarse_conf = coarse_conf,
+                                  margin = margin, max_skip = max_skip)
+
+    ground_truth = load_ground_truth(gt_path)
+    exhaustive_metrics = evaluate_predictions(ground_truth, load_predictions(exhaustive_path))
+    coarse_metrics = evaluate_predictions(ground_truth, load_predictions(coarse_path))
+    report = {
+        'skipped_fraction': coarse['skipped_fraction'],
+        'wall_s': exhaustive['wall_s'],
+        'coarse_to_fine_wall_s': coarse['wall_s'],
+        'bbox_mAP50': exhaustive_metrics['bbox_mAP50'],
+        'coarse_to_fine_bbox_mAP50': coarse_metrics['bbox_mAP50']
+    }
+    for threshold, counts in exhaustive_metrics['counts'].items():
+        report[f'recall@{threshold}'] = counts['recall']
+        report[f'coarse_to_fine_recall@{threshold}'] = coarse_metrics['counts'][threshold]['recall']
+        report[f'recall_lost@{threshold}'] = counts['recall'] - coarse_metrics['counts'][threshold]['recall']
+
+    with open(os.path.join(output_dir, 'coarse_to_fine.json'), 'w') as file:
+        json.dump(report, file, indent = 4)
+    print(f'Skipped {report["skipped_fraction"]:.1%} of the slices, {report["wall_s"]:.1f}s -> {report["coarse_to_fine_wall_s"]:.1f}s, '
+          f'recall lost at iou 0.5: {report["recall_lost@0.5"]:.3f}.')
+    return report
+
+def merge_result_file(result_path, output_path, postprocess = 'GREEDYNMM', match_metric = 'IOS', match_threshold = 0.5,
+                      class_agnostic = False, assume_grouped = False):
+    # merges the detections of an existing result.json again (e.g. a low threshold dump with another postprocess),
+    # one image at a time so the file never has to fit in memory
+    category_names = {}
+    detections = 0
+    with open(output_path, 'w') as file:
+        file.write('[')
+        for image_id, bbox, scores, categories in iter_image_batches(result_path, assume_grouped, category_names):
+            boxes = np.concatenate([bbox[:, :2], bbox[:, :2] + bbox[:, 2:]], axis = 1)
+            merged = merge_predictions(boxes, scores, categories, postprocess, match_metric, match_threshold, class_agnostic)
+            for result in to_coco_results(image_id, *merged, category_names):
+                file.write((',' if detections else '') + json.dumps(result, separators = (',', ':')))
+                detections += 1
+        file.write(']')
+    print(f'Merged "{result_path}" into {detections} detections in "{output_path}".')
+    return detections
+
+def config_name(slice_size, overlap):
+    # same folder names as runs/*/sahi, e.g. 320_12
+    return f'{slice_size}_{round(overlap * 100):02d}'
+
+def run_multi_config(predict, gt_path, image_dir, output_dir, configs = ((320, 0.2), (640, 0.2), (960, 0.2), (1280, 0.2)),
+                     batch_size = 16, decode_workers = 2, prefetch = 4, full_image_pred = True, postprocess = 'GREEDYNMM',
+                     match_metric = 'IOS', match_threshold = 0.5, class_agnostic = False, multi_scale = True, evaluate = True,
+                     image_cache = None):
+    # every (slice size, overlap) of configs in one job: each image is decoded once, the slices of every config are
+    # views into the same array and the full image pass is run once and shared. writes
+    # output_dir/<size>_<overlap>/result.json (and eval.json) per config, with multi_scale also the merge of all
+    # configs' predictions in output_dir/multi_scale
+    with open(gt_path) as file:
+        gt = json.load(file)
+    category_names = {category['id']: category['name'] for category in gt['categories']}
+    images = gt['images']
+
+    names = [config_name(slice_size, overlap) for slice_size, overlap in configs]
+    if multi_scale:
+        names.append('multi_scale')
+    results = {name: [] for name in names}
+    timings = {name: [] for name in names}
+
+    wall_start = time.perf_counter()
+    decode = decode_image if image_cache is None else cached_decoder(image_cache)
+    decoded = iter_decoded([os.path.join(image_dir, image['file_name']) for image in images], decode_workers, prefetch, decode)
+    for image, (array, decode_seconds) in zip(images, decoded):
+        full_image_prediction = predict([array])[0] if full_image_pred else None
+        merged = []
+        for name, (slice_size, overlap) in zip(names, configs):
+            start = time.perf_counter()
+            prediction, timing = predict_image(predict, array, slice_size, overlap, batch_size, full_image_pred,
+                                               postprocess, match_metric, match_threshold, class_agnostic,
+                                               full_image_prediction = full_image_prediction)
+            results[name].extend(to_coco_results(image['id'], *prediction, category_names))
+            timing['decode'] = decode_seconds
+            timing['total'] = time.perf_counter() - start
+            timings[name].append(timing)
+            merged.append(prediction)
+
+        if multi_scale:
+            # the merged boxes of every config merged again, like sahi merges the slices of one config
+            start = time.perf_counter()
+            boxes, scores, categories = (np.concatenate(parts) for parts in zip(*merged))
+            prediction = merge_predictions(boxes, scores, categories, postprocess, match_metric, match_threshold, class_agnostic)
+            results['multi_scale'].extend(to_coco_results(image['id'], *prediction, category_names))
+            merge_seconds = time.perf_counter() - start
+            timings['multi_scale'].append({'decode': decode_seconds, 'coarse': 0.0, 'slice': 0.0, 'infer': 0.0,
+                                           'merge': merge_seconds, 'total': merge_seconds})
+
+    ground_truth = load_ground_truth(gt_path) if evaluate else None
+    reports = {}
+    for name in names:
+        config_dir = os.path.join(output_dir, name)
+        os.makedirs(config_dir, exist_ok = True)
+        output_path = os.path.join(config_dir, 'result.json')
+        with open(output_path, 'w') as file:
+            json.dump(results[name], file, separators = (',', ':'))
+        reports[name] = {'images': len(images), 'detections': len(results[name]),
+                         'stages': summarize_timings(timings[name]) if timings[name] else {}}
+        with open(os.path.join(config_dir, 'result_timings.json'), 'w') as file:
+            json.dump({'summary': reports[name], 'per_image': timings[name]}, file, indent = 4)
+        if evaluate:
+            reports[name]['metrics'] = evaluate_predictions(ground_truth, load_predictions(output_path))
+            write_eval_json(reports[name]['metrics'], os.path.join(config_dir, 'eval.json'))
+
+    if image_cache is not None:
+        cache_report(image_cache)
+    print(f'Predicted {len(images)} images at {len(configs)} configs in {time.perf_counter() - wall_start:.1f}s, '
+          f'results written to "{output_dir}".')
+    return reports
+
+if __name__ == '__main__':
+    run_sliced_inference(yolo_predictor('./runs/yolov8n_100e_0p_16b_auto_320_12/training/train/weights/best.pt', image_size = 320),
+                         gt_path = '../heridal/testImages/coco_test_label.json',
+                         image_dir = '../heridal/testImages',
+                         output_path = './runs/yolov8n_100e_0p_16b_auto_320_12/sahi/320_12/result_batched.json',
+                         slice_size = 320,
+                         overlap = 0.12,
+                         batch_size = 16)
@@ -0,0 +1,185 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from coco_writer import write_coco
+from image_cache import cached_decode, add_lookup, cache_report
+
+# slice full-res images into tiles like sahi's slice_coco, but only the tiles that end up with at least one
+# annotation are cropped, encoded and written (no need for cleanup.remove_unused_images afterwards)
+
+def get_slice_bboxes(image_height, image_width, slice_size = 320, overlap = 0.12):
+    # same grid as sahi.slicing.get_slice_bboxes, the last row/column is shifted back to stay inside the image
+    slice_bboxes = []
+    step_overlap = int(overlap * slice_size)
+    y_min = y_max = 0
+    while y_max < image_height:
+        x_min = x_max = 0
+        y_max = y_min + slice_size
+        while x_max < image_width:
+            x_max = x_min + slice_size
+            if y_max > image_height or x_max > image_width:
+                xmax = min(image_width, x_max)
+                ymax = min(image_height, y_max)
+                slice_bboxes.append([max(0, xmax - slice_size), max(0, ymax - slice_size), xmax, ymax])
+            else:
+                slice_bboxes.append([x_min, y_min, x_max, y_max])
+            x_min = x_max - step_overlap
+        y_min = y_max - step_overlap
+    return np.array(slice_bboxes, dtype = np.int64).reshape(-1, 4)
+
+def clip_boxes_to_slices(slices, boxes, min_area_ratio = 0.1):
+    # slices and boxes are xyxy arrays, returns the clipped boxes (slices x boxes x 4) and which of them are kept
+    x1 = np.maximum(slices[:, None, 0], boxes[None, :, 0])
+    y1 = np.maximum(slices[:, None, 1], boxes[None, :, 1])
+    x2 = np.minimum(slices[:, None, 2], boxes[None, :, 2])
+    y2 = np.minimum(slices[:, None, 3], boxes[None, :, 3])
+
+    visible = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = (visible > 0) & (visible >= min_area_ratio * area[None, :])
+    return np.stack([x1, y1, x2, y2], axis = -1), keep
+
+def greedy_tile_cover(cover, k = 1):
+    # cover is slices x objects (object is whole in that slice). greedy set cover: keep taking the slice that
+    # covers the most objects still needing coverage until every object is covered k times (or as often as it can be)
+    need = np.minimum(cover.sum(axis = 0), k)
+    available = np.ones(len(cover), dtype = bool)
+    chosen = []
+    while need.any():
+        gains = cover[:, need > 0].sum(axis = 1) * available
+        best = int(np.argmax(gains))
+        if gains[best] == 0:
+            break
+        chosen.append(best)
+        available[best] = False
+        need = np.maximum(need - cover[best], 0)
+    return chosen
+
+def select_cover_slices(slices, boxes, k = 1):
+    # slices so every object is whole at least k times, objects that are never whole in any slice
+    # (bigger than the slice or always cut) get the slice where most of them is visible instead
+    clipped, whole = clip_boxes_to_slices(slices, boxes, 1.0)
+    chosen = set(greedy_tile_cover(whole, k))
+
+    uncoverable = np.flatnonzero(~whole.any(axis = 0))
+    if len(uncoverable):
+        visible = (np.clip(clipped[..., 2] - clipped[..., 0], 0, None) * np.clip(clipped[..., 3] - clipped[..., 1], 0, None))[:, uncoverable]
+        chosen.update(np.argmax(visible, axis = 0).tolist())
+    return np.array(sorted(chosen), dtype = np.int64)
+
+def slice_image(image_path, image, annotations, output_dir, slice_size, overlap, min_area_ratio, out_ext, quality, cover_k = None,
+                image_cache = None):
+    # runs in a worker process, returns the kept tiles with their annotations relative to the tile and the
+    # image_cache lookup of the image (hit, seconds, evicted), None when not cached
+    if not annotations:
+        return [], None
+
+    slices = get_slice_bboxes(image['height'], image['width'], slice_size, overlap)
+    # no dtype given on purpose, integer voc boxes stay integers in the output json
+    boxes = np.array([[x, y, x + w, y + h] for x, y, w, h in (annotation['bbox'] for annotation in annotations)])
+    clipped, keep = clip_boxes_to_slices(slices, boxes, min_area_ratio)
+
+    # every annotated slice, or with cover_k only the few slices needed to show every object whole cover_k times
+    if cover_k:
+        kept_slices = select_cover_slices(slices, boxes, cover_k)
+    else:
+        kept_slices = np.flatnonzero(keep.any(axis = 1))
+    if len(kept_slices) == 0:
+        return [], None
+
+    stem = os.path.splitext(image['file_name'])[0]
+    tiles = []
+    lookup = None
+    if image_cache is None:
+        full_image = Image.open(image_path)
+        full_image.load()
+        crop = lambda x1, y1, x2, y2: full_image.crop((x1, y1, x2, y2))
+    else:
+        # counted on a copy of the cache dict (workers have their own anyway), slice_coco adds up the lookups
+        array, hit, seconds, evicted = cached_decode(dict(image_cache), image_path)
+        lookup = (hit, seconds, evicted)
+        full_image = None
+        crop = lambda x1, y1, x2, y2: Image.fromarray(np.ascontiguousarray(array[y1:y2, x1:x2]))
+    try:
+        for slice_index in kept_slices:
+            x1, y1, x2, y2 = slices[slice_index].tolist()
+            file_name = f'{stem}_{x1}_{y1}_{x2}_{y2}{out_ext}'
+            crop(x1, y1, x2, y2).save(os.path.join(output_dir, file_name), quality = quality)
+
+            tile_annotations = []
+            for annotation_index in np.flatnonzero(keep[slice_index]):
+                bx1, by1, bx2, by2 = clipped[slice_index, annotation_index].tolist()
+                tile_annotations.append({
+                    'bbox': [bx1 - x1, by1 - y1, bx2 - bx1, by2 - by1],
+                    'category_id': annotations[annotation_index]['category_id']
+                })
+            tiles.append((file_name, x2 - x1, y2 - y1, tile_annotations))
+    finally:
+        if full_image is not None:
+            full_image.close()
+    return tiles, lookup
+
+def slice_coco(coco_path, image_dir, output_dir, output_filename, slice_size = 320, overlap = 0.12,
+               min_area_ratio = 0.1, out_ext = '.jpg', quality = 95, workers = 1, compact = False, cover_k = None,
+               image_cache = None):
+    # image_cache (from image_cache.open_image_cache) keeps the decoded images, e.g. when slicing at several sizes
+    with open(coco_path) as file:
+        coco = json.load(file)
+    os.makedirs(output_dir, exist_ok = True)
+
+    annotations_by_image = {}
+    for annotation in coco['annotations']:
+        annotations_by_image.setdefault(annotation['image_id'], []).append(annotation)
+
+    jobs = [(os.path.join(image_dir, image['file_name']), image, annotations_by_image.get(image['id'], []),
+             output_dir, slice_size, overlap, min_area_ratio, out_ext, quality, cover_k, image_cache) for image in coco['images']]
+
+    if workers <= 1:
+        results = [slice_image(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(slice_image, *zip(*jobs))) if jobs else []
+
+    # ids are assigned here in image order so the output does not depend on the worker count
+    c_images = []
+    c_annotations = []
+    for tiles, _ in results:
+        for file_name, width, height, tile_annotations in tiles:
+            image_id = len(c_images) + 1
+            c_images.append({'file_name': file_name, 'height': height, 'width': width, 'id': image_id})
+            for annotation in tile_annotations:
+                bbox = annotation['bbox']
+                c_annotations.append({
+                    'area': bbox[2] * bbox[3],
+                    'iscrowd': 0,
+                    'bbox': bbox,
+                    'category_id': annotation['category_id'],
+                    'image_id': image_id,
+                    'id': len(c_annotations) + 1
+                })
+
+    sliced = {'images': c_images, 'annotations': c_annotations, 'categories': coco['categories']}
+    write_coco(output_filename, sliced, compact)
+
+    if image_cache is not None:
+        for _, lookup in results:
+            if lookup is not None:
+                add_lookup(image_cache, *lookup)
+        cache_report(image_cache)
+
+    total_slices = sum(len(get_slice_bboxes(image['height'], image['width'], slice_size, overlap)) for image in coco['images'])
+    print(f'Sliced {len(coco["images"])} images into {len(c_images)} annotated tiles out of {total_slices}, with {len(c_annotations)} annotations.')
+    return sliced
+
+if __name__ == '__main__':
+    slice_coco(coco_path = '../heridal/trainImages/coco_train_label.json',
+               image_dir = '../heridal/trainImages',
+               output_dir = './datasets/320_12/coco_train_label_images_320_012',
+               output_filename = './datasets/320_12/coco_train_label_320_012.json',
+               slice_size = 320,
+               overlap = 0.12,
+               workers = os.cpu_count())
@@ -0,0 +1,161 @@
+import io
+import os
+import json
+import random
+
+import numpy as np
+from PIL import Image
+
+from coco_writer import write_coco
+
+# a fake heridal for timing the tools without the real dataset: voc label folders (with the empty <annotation/>
+# files and the label files without an image that voc2coco reports), dummy images, a coco ground truth and sahi-like
+# result.json files. scale 1 is the size of heridal, scale 10 has ten times the images, and so on.
+# the images are empty files by default (voc2coco and cleanup only look at the names), with jpg = True every image
+# is a real jpg of the full size (the same encoded noise each time, so writing them stays fast)
+
+# counts from the voc2coco log at the bottom of voc2coco.py
+HERIDAL = {
+    'train_files': 1548,
+    'test_files': 103,
+    'train_invalid_ratio': 563 / 1548,
+    'test_missing_image_ratio': 2 / 103,
+    'objects_per_file': 3,
+    'width': 4000,
+    'height': 3000
+}
+CATEGORIES = [{"supercategory": "none", "id": 0, "name": "human"}]
+
+def encode_dummy_image(width, height, seed = 0):
+    # noise compresses badly, so the file size is close to a real aerial photo
+    pixels = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype = np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format = 'JPEG', quality = 90)
+    return buffer.getvalue()
+
+def make_voc_records(n_files, objects_per_file = 3, invalid_ratio = 0.35, missing_image_ratio = 0.0,
+                     width = 4000, height = 3000, seed = 0):
+    # (name, objects or None for an empty <annotation/>, whether the image exists) of every label file
+    rng = random.Random(seed)
+    records = []
+    for i in range(n_files):
+        objects = None
+        # the heridal label set has a lot of empty <annotation/> files
+        if rng.random() >= invalid_ratio:
+            objects = []
+            for _ in range(rng.randint(1, objects_per_file * 2 - 1)):
+                x = rng.randint(0, width - 100)
+                y = rng.randint(0, height - 100)
+                objects.append((x, y, x + rng.randint(20, 100), y + rng.randint(20, 100)))
+        records.append((f'SYN_{i:06d}', objects, rng.random() >= missing_image_ratio))
+    return records
+
+def write_voc_dataset(root, records, prefix = 'train_', width = 4000, height = 3000, image_bytes = b''):
+    # labels/<prefix><name>.xml and <prefix><name>.JPG next to it, like heridal's trainImages and testImages
+    label_dir = os.path.join(root, 'labels')
+    os.makedirs(label_dir, exist_ok = True)
+
+    for name, objects, has_image in records:
+        if has_image:
+            with open(os.path.join(root, f'{prefix}{name}.JPG'), 'wb') as file:
+                file.write(image_bytes)
+
+        if objects is None:
+            xml = '<annotation></annotation>'
+        else:
+            xml = ''.join('<object><name>human</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>'
+                          f'<bndbox><xmin>{x1}</xmin><ymin>{y1}</ymin><xmax>{x2}</xmax><ymax>{y2}</ymax></bndbox></object>'
+                          for x1, y1, x2, y2 in objects)
+            xml = (f'<annotation><folder>{os.path.basename(os.path.normpath(root))}</folder><filename>{name}</filename>'
+                   f'<size><width>{width}</width><height>{height}</height><depth>3</depth></size>'
+                   f'<segmented>0</segmented>{xml}</annotation>')
+
+        with open(os.path.join(label_dir, f'{prefix}{name}.xml'), 'w') as file:
+            file.write(xml)
+    return label_dir
+
+def make_voc_dataset(root, n_files = 2000, objects_per_file = 3, invalid_ratio = 0.35, prefix = 'train_', seed = 0,
+                     missing_image_ratio = 0.0, jpg = False):
+    # returns the label folder, the images are in root
+    records = make_voc_records(n_files, objects_per_file, invalid_ratio, missing_image_ratio, seed = seed)
+    image_bytes = encode_dummy_image(HERIDAL['width'], HERIDAL['height'], seed) if jpg else b''
+    return write_voc_dataset(root, records, prefix, HERIDAL['width'], HERIDAL['height'], image_bytes)
+
+def records_to_coco(records, prefix = 'test_', width = 4000, height = 3000, categories = CATEGORIES):
+    # the images and boxes voc2coco gets from these label files, numbered in record order (voc2coco uses os.listdir's)
+    images = []
+    annotations = []
+    for name, objects, has_image in records:
+        if objects is None or not has_image:
+            continue
+        image_id = len(images) + 1
+        images.append({'file_name': f'{prefix}{name}.JPG', 'height': height, 'width': width, 'id': image_id})
+        for x1, y1, x2, y2 in objects:
+            annotations.append({'area': (x2 - x1) * (y2 - y1), 'iscrowd': 0, 'bbox': [x1, y1, x2 - x1, y2 - y1],
+                                'category_id': categories[0]['id'], 'ignore': 0, 'image_id': image_id,
+                                'id': len(annotations) + 1})
+    return {'images': images, 'annotations': annotations, 'categories': categories}
+
+def make_results(coco, recall = 0.7, false_positives = 1.0, score_floor = 0.5, seed = 0):
+    # a sahi result.json list for a ground truth: each object is found with probability recall (with a few pixels
+    # of error on every side) and every image gets a poisson number of false positives. the runs in runs/ have
+    # 3 to 4 detections per image above sahi's 0.5 confidence
+    rng = np.random.default_rng(seed)
+    names = {category['id']: category['name'] for category in coco['categories']}
+    boxes_by_image = {}
+    for annotation in coco['annotations']:
+        boxes_by_image.setdefault(annotation['image_id'], []).append((annotation['bbox'], annotation['category_id']))
+
+    results = []
+    for image in coco['images']:
+        detections = []
+        for (x, y, w, h), category in boxes_by_image.get(image['id'], []):
+            if rng.random() < recall:
+                dx1, dy1, dx2, dy2 = rng.normal(0, 3, 4).tolist()
+                detections.append(([x + dx1, y + dy1, max(w + dx2 - dx1, 1.0), max(h + dy2 - dy1, 1.0)],
+                                   float(rng.uniform(max(score_floor, 0.6), 0.9)), category))
+        for _ in range(rng.poisson(false_positives)):
+            w, h = rng.uniform(30, 100, 2).tolist()
+            x, y = rng.uniform(0, image['width'] - w), rng.uniform(0, image['height'] - h)
+            detections.append(([x, y, w, h], float(rng.uniform(score_floor, 0.8)), coco['categories'][0]['id']))
+
+        # sahi writes the detections grouped by image, highest score first
+        for bbox, score, category in sorted(detections, key = lambda detection: -detection[1]):
+            results.append({'image_id': image['id'], 'bbox': bbox, 'score': score, 'category_id': category,
+                            'category_name': names[category], 'segmentation': [], 'iscrowd': 0,
+                            'area': int(bbox[2] * bbox[3])})
+    return results
+
+def make_heridal_dataset(root, scale = 1, runs = 1, jpg = False, seed = 0):
+    # root/trainImages, root/testImages (with coco_test_label.json) and root/runs/synthetic_<n>/sahi/320_12/result.json,
+    # the same layout the tools expect next to this repo
+    train_dir = os.path.join(root, 'trainImages')
+    test_dir = os.path.join(root, 'testImages')
+    image_bytes = encode_dummy_image(HERIDAL['width'], HERIDAL['height'], seed) if jpg else b''
+
+    train_records = make_voc_records(round(HERIDAL['train_files'] * scale), HERIDAL['objects_per_file'],
+                                     HERIDAL['train_invalid_ratio'], 0.0, HERIDAL['width'], HERIDAL['height'], seed)
+    write_voc_dataset(train_dir, train_records, 'train_', HERIDAL['width'], HERIDAL['height'], image_bytes)
+    test_records = make_voc_records(round(HERIDAL['test_files'] * scale), HERIDAL['objects_per_file'], 0.0,
+                                    HERIDAL['test_missing_image_ratio'], HERIDAL['width'], HERIDAL['height'], seed + 1)
+    write_voc_dataset(test_dir, test_records, 'test_', HERIDAL['width'], HERIDAL['height'], image_bytes)
+
+    gt = records_to_coco(test_records, 'test_', HERIDAL['width'], HERIDAL['height'])
+    gt_path = os.path.join(test_dir, 'coco_test_label.json')
+    write_coco(gt_path, gt)
+
+    result_paths = []
+    for run in range(runs):
+        result_dir = os.path.join(root, 'runs', f'synthetic_{run}', 'sahi', '320_12')
+        os.makedirs(result_dir, exist_ok = True)
+        result_paths.append(os.path.join(result_dir, 'result.json'))
+        with open(result_paths[-1], 'w') as file:
+            # sahi's separators
+            json.dump(make_results(gt, seed = seed + run), file, separators = (',', ':'))
+
+    return {'train_dir': train_dir, 'train_labels': os.path.join(train_dir, 'labels'), 'test_dir': test_dir,
+            'test_labels': os.path.join(test_dir, 'labels'), 'gt_path': gt_path, 'result_paths': result_paths,
+            'train_files': len(train_records), 'test_files': len(test_records)}
+
+if __name__ == '__main__':
+    make_heridal_dataset('./synthetic_heridal', scale = 1, runs = 4)
@@ -0,0 +1,39 @@
+import os
+
+from voc2coco import voc2coco
+from optimal_overlap_calcu import optimize_overlap, optimize_overlap_sweep
+
+# the overlap table has to be the same whatever the boxes are read from: the voc labels, the coco json voc2coco
+# makes from them or the columnar store
+
+CATEGORIES = [{'supercategory': 'none', 'id': 0, 'name': 'human'}]
+BOXES = [[(10, 20, 40, 80), (100, 100, 131, 117)], [(5, 5, 60, 25)], [(200, 300, 212, 390), (0, 0, 9, 9), (50, 60, 90, 61)]]
+
+def write_labels(root):
+    label_dir = os.path.join(root, 'labels')
+    os.makedirs(label_dir)
+    for index, boxes in enumerate(BOXES):
+        open(os.path.join(root, f'image_{index}.jpg'), 'wb').close()
+        objects = ''.join(f'<object><name>human</name><bndbox><xmin>{x1}</xmin><ymin>{y1}</ymin><xmax>{x2}</xmax>'
+                          f'<ymax>{y2}</ymax></bndbox></object>' for x1, y1, x2, y2 in boxes)
+        with open(os.path.join(label_dir, f'image_{index}.xml'), 'w') as file:
+            file.write(f'<annotation><filename>image_{index}</filename><size><width>400</width><height>400</height>'
+                       f'</size>{objects}</annotation>')
+    return label_dir
+
+def test_voc_coco_and_columnar_give_the_same_table(tmp_path):
+    label_dir = write_labels(str(tmp_path))
+    json_path = os.path.join(str(tmp_path), 'coco.json')
+    columnar_dir = os.path.join(str(tmp_path), 'columnar')
+    voc2coco(label_dir, str(tmp_path), '', '.jpg', json_path, CATEGORIES, columnar_dir = columnar_dir)
+
+    voc_table = optimize_overlap_sweep(label_dir)
+    assert optimize_overlap_sweep(json_path) == voc_table
+    assert optimize_overlap_sweep(columnar_dir) == voc_table
+    assert voc_table[0]['object_w'] == 55 and voc_table[0]['object_h'] == 90
+
+def test_optimize_overlap_keeps_the_inclusive_voc_sizes(tmp_path):
+    # the old printout counted voc coordinates as inclusive (max - min + 1), its numbers stay the same
+    largest, average = optimize_overlap(write_labels(str(tmp_path)), 320, 320)
+    assert largest['object_w'] == 56 and largest['object_h'] == 91
+    assert largest['overlap_w'] == 0.09 and largest['overlap_h'] == 0.15
@@ -0,0 +1,22 @@
+import json
+
+from prediction_store import save_predictions, load_predictions_store, store_to_results
+
+# the store has to give back exactly the result.json it was made from
+
+def detection(image_id, bbox, score, area):
+    return {'image_id': image_id, 'bbox': bbox, 'score': score, 'category_id': 0, 'category_name': 'human',
+            'segmentation': [], 'iscrowd': 0, 'area': area}
+
+def round_trip(path, results):
+    save_predictions(str(path), results)
+    return store_to_results(load_predictions_store(str(path)))
+
+def test_fractional_areas_round_trip(tmp_path):
+    results = [detection(2, [10.5, 20.25, 30.0, 40.0], 0.9, 1200.5), detection(1, [1.0, 2.0, 3.0, 4.0], 0.8, 12.25),
+               detection(1, [5.0, 6.0, 7.5, 8.0], 0.7, 60)]
+    assert json.dumps(round_trip(tmp_path, results)) == json.dumps(results)
+
+def test_int_areas_round_trip(tmp_path):
+    results = [detection(1, [1.0, 2.0, 3.0, 4.0], 0.8, 12), detection(3, [5.0, 6.0, 7.5, 8.0], 0.7, 60)]
+    assert json.dumps(round_trip(tmp_path, results)) == json.dumps(results)
@@ -0,0 +1,21 @@
+import os
+import json
+
+from tile_shards import pack_dataset, open_shards, close_shards, iter_tiles, export_yolo
+
+CATEGORIES = [{'supercategory': 'none', 'id': 0, 'name': 'human'}]
+
+def test_ground_truth_without_images_gives_an_empty_index(tmp_path):
+    coco_path = os.path.join(str(tmp_path), 'coco.json')
+    with open(coco_path, 'w') as file:
+        json.dump({'images': [], 'annotations': [], 'categories': CATEGORIES}, file)
+    shard_dir = os.path.join(str(tmp_path), 'shards')
+
+    meta = pack_dataset(coco_path, str(tmp_path), shard_dir)
+    assert meta['shards'] == [] and meta['categories'] == CATEGORIES
+
+    store = open_shards(shard_dir)
+    assert len(store['index']['image_id']) == 0 and store['index']['boxes'].shape == (0, 4)
+    close_shards(store)
+    assert list(iter_tiles(shard_dir)) == []
+    assert export_yolo(shard_dir, os.path.join(str(tmp_path), 'yolo')) == 0
@@ -0,0 +1,43 @@
+import os
+import json
+
+from voc2coco import voc2coco
+from synthetic_dataset import CATEGORIES, make_voc_records, write_voc_dataset
+
+# an incremental rerun after a label file was edited has to give the annotations of a clean run, with every object
+# that was already there keeping its id, wherever it moved in the xml
+
+def convert(root, output_name, incremental):
+    output_path = os.path.join(root, output_name)
+    voc2coco(os.path.join(root, 'labels'), root, 'train_', '.JPG', output_path, CATEGORIES, incremental = incremental,
+             verbose = False)
+    with open(output_path) as file:
+        return json.load(file)
+
+def annotation_ids(coco):
+    # {(file name, bbox): id}
+    file_names = {image['id']: image['file_name'] for image in coco['images']}
+    return {(file_names[annotation['image_id']], tuple(annotation['bbox'])): annotation['id']
+            for annotation in coco['annotations']}
+
+def test_incremental_rerun_after_an_edit_matches_a_clean_run(tmp_path):
+    root = str(tmp_path)
+    records = make_voc_records(20, invalid_ratio = 0.2, seed = 3)
+    write_voc_dataset(root, records)
+    before = annotation_ids(convert(root, 'coco.json', True))
+
+    # a new object at the top of a file and the old ones in reverse order
+    index = next(i for i, (_, objects, _) in enumerate(records) if objects is not None and len(objects) >= 2)
+    name, objects, has_image = records[index]
+    records[index] = (name, [(1, 2, 31, 42)] + objects[::-1], has_image)
+    write_voc_dataset(root, records)
+
+    incremental = convert(root, 'coco.json', True)
+    clean = convert(root, 'clean.json', False)
+    after = annotation_ids(incremental)
+    assert set(after) == set(annotation_ids(clean))
+    assert [image['file_name'] for image in incremental['images']] == [image['file_name'] for image in clean['images']]
+
+    assert all(after[key] == ann_id for key, ann_id in before.items())
+    assert after[(f'train_{name}.JPG', (1, 2, 30, 40))] == max(before.values()) + 1
+    assert len(set(after.values())) == len(after)
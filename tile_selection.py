@@ -0,0 +1,61 @@
+import re
+
+import numpy as np
+
+from slicer import get_slice_bboxes, clip_boxes_to_slices, select_cover_slices
+from coco_columnar import load_coco_columns
+from slice_planner import group_boxes_by_image
+
+# how many training tiles the greedy cover selection (slicer.slice_coco(..., cover_k = k)) keeps compared to
+# keeping every tile with an annotation in it, and what that does to the epoch time
+
+EPOCHS_PATTERN = re.compile(r'(\d+) epochs completed in ([\d.]+) hours')
+
+def parse_epoch_seconds(training_output):
+    # average seconds per epoch from an ultralytics training output.txt
+    with open(training_output, encoding = 'utf-8', errors = 'replace') as file:
+        match = EPOCHS_PATTERN.search(file.read())
+    if match is None:
+        return None
+    return float(match.group(2)) * 3600 / int(match.group(1))
+
+def select_training_tiles(gt_source, slice_size = 320, overlap = 0.12, k = 1, min_area_ratio = 0.1, epoch_seconds = None):
+    columns = load_coco_columns(gt_source)
+    images = columns['images']
+    boxes_by_image = group_boxes_by_image(columns)
+
+    annotated = 0
+    selected = 0
+    grids = {}
+    for image_id, height, width in zip(np.asarray(images['id']).tolist(), np.asarray(images['height']).tolist(), np.asarray(images['width']).tolist()):
+        if image_id not in boxes_by_image:
+            continue
+        if (height, width) not in grids:
+            grids[(height, width)] = get_slice_bboxes(height, width, slice_size, overlap)
+        slices = grids[(height, width)]
+        boxes = boxes_by_image[image_id]
+
+        # what survives cleanup.remove_unused_images today vs. the greedy cover
+        annotated += int(clip_boxes_to_slices(slices, boxes, min_area_ratio)[1].any(axis = 1).sum())
+        selected += len(select_cover_slices(slices, boxes, k))
+
+    report = {
+        'slice_size': slice_size,
+        'overlap': overlap,
+        'k': k,
+        'annotated_tiles': annotated,
+        'selected_tiles': selected,
+        'reduction': 1 - selected / annotated if annotated else 0.0,
+        'epoch_seconds': epoch_seconds,
+        # training time per epoch scales with the number of tiles
+        'est_epoch_seconds': epoch_seconds * selected / annotated if epoch_seconds and annotated else None
+    }
+
+    print(f'{slice_size}_{round(overlap * 100):02d} k={k}: {selected} of {annotated} annotated tiles selected ({report["reduction"]:.1%} fewer).')
+    if report['est_epoch_seconds'] is not None:
+        print(f'Estimated epoch time {report["est_epoch_seconds"]:.0f}s instead of {epoch_seconds:.0f}s.')
+    return report
+
+if __name__ == '__main__':
+    select_training_tiles('../heridal/trainImages/coco_train_label.json', 320, 0.30, k = 1,
+                          epoch_seconds = parse_epoch_seconds('./runs/yolov8n_100e_0p_16b_AdamW_320_30/training/output.txt'))
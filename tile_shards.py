@@ -0,0 +1,157 @@
+import os
+import json
+import mmap
+
+import numpy as np
+
+from coco_columnar import load_coco_columns
+
+# a sliced dataset (thousands of small jpg tiles + a coco json) packed into a few large shard files: the encoded
+# tiles are appended as they are (no re-encoding) and an index keeps where every tile is (shard, offset, length)
+# and its boxes. one open per shard instead of per tile, which is what costs the most on network storage.
+# the index is stored like coco_columnar (one .npy per column + meta.json)
+
+SHARD_SIZE = 256 * 2**20
+
+def pack_dataset(coco_source, image_dir, output_dir, shard_size = SHARD_SIZE):
+    # coco_source is the sliced dataset's coco json (or a columnar store), only images listed in it are packed
+    columns = load_coco_columns(coco_source)
+    # a ground truth without images has no columns at all, it gives an empty index
+    images = columns.get('images') or {}
+    annotations = columns.get('annotations') or {}
+    image_ids = np.asarray(images.get('id', []), dtype = np.int64)
+    file_names = np.asarray(images.get('file_name', []), dtype = str)
+    # xywh boxes and category ids of every image, in annotation order
+    labels = {}
+    if annotations:
+        annotation_image_ids = np.asarray(annotations['image_id'])
+        order = np.argsort(annotation_image_ids, kind = 'stable')
+        unique_ids, starts = np.unique(annotation_image_ids[order], return_index = True)
+        bbox = np.asarray(annotations['bbox'], dtype = np.float64)
+        category_ids = np.asarray(annotations['category_id'], dtype = np.int64)
+        for image_id, indices in zip(unique_ids.tolist(), np.split(order, starts[1:])):
+            labels[image_id] = (bbox[indices], category_ids[indices])
+
+    os.makedirs(output_dir, exist_ok = True)
+    index = {'shard': [], 'offset': [], 'length': [], 'box_start': [], 'box_count': []}
+    boxes, categories = [], []
+    shards = []
+    shard = None
+    for image_id, file_name in zip(image_ids.tolist(), file_names.tolist()):
+        with open(os.path.join(image_dir, file_name), 'rb') as file:
+            data = file.read()
+        if shard is None or shard.tell() + len(data) > shard_size and shard.tell() > 0:
+            if shard is not None:
+                shard.close()
+            shards.append(f'shard-{len(shards):05d}.bin')
+            shard = open(os.path.join(output_dir, shards[-1]), 'wb')
+        index['shard'].append(len(shards) - 1)
+        index['offset'].append(shard.tell())
+        index['length'].append(len(data))
+        shard.write(data)
+
+        image_boxes, image_categories = labels.get(image_id, (np.zeros((0, 4)), np.zeros(0, dtype = np.int64)))
+        index['box_start'].append(len(boxes))
+        index['box_count'].append(len(image_boxes))
+        boxes.extend(image_boxes.tolist())
+        categories.extend(image_categories.tolist())
+    if shard is not None:
+        shard.close()
+
+    arrays = {name: np.array(values, dtype = np.int64) for name, values in index.items()}
+    arrays['image_id'] = image_ids
+    arrays['width'] = np.asarray(images.get('width', []), dtype = np.int64)
+    arrays['height'] = np.asarray(images.get('height', []), dtype = np.int64)
+    arrays['file_name'] = file_names
+    arrays['boxes'] = np.array(boxes, dtype = np.float64).reshape(-1, 4)
+    arrays['category_id'] = np.array(categories, dtype = np.int64)
+    for name, array in arrays.items():
+        np.save(os.path.join(output_dir, f'index.{name}.npy'), array)
+
+    # meta.json goes last, like coco_columnar
+    meta = {'version': 1, 'shards': shards, 'columns': list(arrays.keys()), 'categories': columns.get('categories', [])}
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+    print(f'Packed {len(arrays["image_id"])} tiles into {len(shards)} shards in "{output_dir}".')
+    return meta
+
+def open_shards(path):
+    # the index (memory-mapped) and one read-only mmap per shard
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    store = {'meta': meta, 'index': {name: np.load(os.path.join(path, f'index.{name}.npy'), mmap_mode = 'r') for name in meta['columns']}}
+    store['shards'] = []
+    for shard in meta['shards']:
+        with open(os.path.join(path, shard), 'rb') as file:
+            store['shards'].append(mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) if os.path.getsize(file.name) else b'')
+    return store
+
+def close_shards(store):
+    for shard in store['shards']:
+        if isinstance(shard, mmap.mmap):
+            shard.close()
+
+def read_tile(store, position):
+    # (encoded image bytes, xywh boxes, category ids, file name) of the tile at that position of the index
+    index = store['index']
+    offset, length = int(index['offset'][position]), int(index['length'][position])
+    data = store['shards'][int(index['shard'][position])][offset:offset + length]
+    box_start, box_count = int(index['box_start'][position]), int(index['box_count'][position])
+    return (data, np.asarray(index['boxes'][box_start:box_start + box_count]),
+            np.asarray(index['category_id'][box_start:box_start + box_count]), str(index['file_name'][position]))
+
+def iter_tiles(path, chunk_size = 2**20):
+    # (position in the index, bytes, boxes, category ids, file name) of every tile in shard order, each shard is
+    # read front to back in large chunks instead of one read per tile
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    index = {name: np.load(os.path.join(path, f'index.{name}.npy')) for name in meta['columns']}
+    order = np.lexsort((index['offset'], index['shard']))
+
+    position = 0
+    for shard_id, shard in enumerate(meta['shards']):
+        with open(os.path.join(path, shard), 'rb') as file:
+            buffer = b''
+            buffer_start = 0
+            while position < len(order) and index['shard'][order[position]] == shard_id:
+                tile = order[position]
+                offset, length = int(index['offset'][tile]), int(index['length'][tile])
+                if offset + length > buffer_start + len(buffer):
+                    file.seek(offset)
+                    buffer = file.read(max(chunk_size, length))
+                    buffer_start = offset
+                data = buffer[offset - buffer_start:offset - buffer_start + length]
+                box_start, box_count = int(index['box_start'][tile]), int(index['box_count'][tile])
+                yield (int(tile), data, index['boxes'][box_start:box_start + box_count], index['category_id'][box_start:box_start + box_count],
+                       str(index['file_name'][tile]))
+                position += 1
+
+def export_yolo(path, output_dir):
+    # images/ and labels/ in the ultralytics layout, class = position of the category in the coco categories
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    classes = {category['id']: number for number, category in enumerate(meta['categories'])}
+    index = {name: np.load(os.path.join(path, f'index.{name}.npy'), mmap_mode = 'r') for name in ('width', 'height')}
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok = True)
+    os.makedirs(os.path.join(output_dir, 'labels'), exist_ok = True)
+
+    count = 0
+    for position, data, boxes, categories, file_name in iter_tiles(path):
+        with open(os.path.join(output_dir, 'images', file_name), 'wb') as file:
+            file.write(data)
+        width, height = int(index['width'][position]), int(index['height'][position])
+        lines = [f'{classes[int(category)]} {(x + w / 2) / width:.6f} {(y + h / 2) / height:.6f} {w / width:.6f} {h / height:.6f}'
+                 for (x, y, w, h), category in zip(boxes.tolist(), categories.tolist())]
+        with open(os.path.join(output_dir, 'labels', os.path.splitext(file_name)[0] + '.txt'), 'w') as file:
+            file.write('\n'.join(lines) + ('\n' if lines else ''))
+        count += 1
+
+    with open(os.path.join(output_dir, 'dataset.yaml'), 'w') as file:
+        file.write(f'path: {os.path.abspath(output_dir)}\ntrain: images\nval: images\n')
+        file.write('names:\n' + ''.join(f'  {number}: {category["name"]}\n' for number, category in enumerate(meta['categories'])))
+    print(f'Exported {count} tiles to "{output_dir}".')
+    return count
+
+if __name__ == '__main__':
+    pack_dataset('./datasets/320_12/coco_train_label_320_012.json', './datasets/320_12/coco_train_label_images_320_012',
+                 './datasets/320_12/shards')
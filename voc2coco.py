@@ -1,6 +1,12 @@
 import os
 import json
+import hashlib
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from coco_writer import write_coco
+from coco_columnar import save_columnar
+from run_metrics import measured_run, stage, count, finish_metrics
 
 def category_name_to_id(categories, name):
     for category in categories:
@@ -8,123 +14,305 @@ def category_name_to_id(categories, name):
             return category['id']
     return -1
 
-def voc2coco(ann_dir = os.getcwd(), img_dir = os.getcwd(), img_file_prefix = '', img_file_extension = '', output_filename = 'coco.json', categories = []):
-    # List the xml label files
-    annotations = []
-    images = []
+def parse_voc_xml(path):
+    # parse a single xml label file into plain tuples/dicts so it can be sent back from a worker process
+    tree = ET.parse(path)
+    root = tree.getroot()
 
-    bad_xml = 0
-    no_image = 0
-    no_error = 0
+    # annotation file is invalid
+    if len(root) < 1:
+        return None
 
-    ann_dir_files = os.listdir(ann_dir)
-    for file in ann_dir_files:
-        if file.endswith('.xml'):
-            annotations.append(file)
-    
-    img_dir_files = os.listdir(img_dir)
-    for file in img_dir_files:
-        if file.endswith(img_file_extension):
-            images.append(file)
+    objects = []
+    for object in tree.findall('object'):
+        bndbox = object.find('bndbox')
+        objects.append((object.find('name').text,
+                        int(bndbox.find('xmin').text),
+                        int(bndbox.find('ymin').text),
+                        int(bndbox.find('xmax').text),
+                        int(bndbox.find('ymax').text)))
+
+    size = root.find('size')
+    return {
+        'filename': root.find('filename').text,
+        'height': int(size.find('height').text),
+        'width': int(size.find('width').text),
+        'objects': objects
+    }
 
-    # Create the coco annotation
-    c_images = []
-    c_annotations = []
-    curr_img_id = 0
-    curr_ann_id = 0
+def parse_voc_files(paths, workers = 1):
+    # results are returned in the same order as paths, so ids can be assigned exactly like the serial loop
+    if workers <= 1 or len(paths) < 2:
+        return [parse_voc_xml(path) for path in paths]
 
-    for ann in annotations:
-        tree = ET.parse(os.path.join(ann_dir, ann))
-        root = tree.getroot()
+    chunksize = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(parse_voc_xml, paths, chunksize = chunksize))
 
-        # skip if annotation file is invalid
-        if len(root) < 1:
-            print(f'Annotation file "{ann}" invalid.')
-            bad_xml += 1
-            continue
+def manifest_path(output_filename):
+    return os.path.splitext(output_filename)[0] + '.manifest.json'
 
-        file_name = img_file_prefix + root.find('filename').text + img_file_extension
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'last_img_id': 0, 'last_ann_id': 0, 'output_fingerprint': None, 'files': {}}
+    with open(path) as file:
+        return json.load(file)
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def previous_objects(entry):
+    # [object, id] of every object a label file had ids for
+    if entry is None:
+        return []
+    # edited again before its ids were handed out
+    if 'previous' in entry:
+        return entry['previous']
+    if entry['record'] is None:
+        return []
+    return [[list(obj), ann_id] for obj, ann_id in zip(entry['record']['objects'], entry['ann_ids'])]
+
+def reuse_ann_ids(entry, record, last_ann_id):
+    # ids for the objects of a label file that has none yet: an object the file already had (same name and box)
+    # gets its old id back wherever it moved in the xml, only new objects get new ids. returns the last id used
+    reuse = {}
+    for obj, ann_id in entry.pop('previous', []):
+        reuse.setdefault(tuple(obj), []).append(ann_id)
+    entry['ann_ids'] = []
+    for obj in record['objects']:
+        if reuse.get(tuple(obj)):
+            entry['ann_ids'].append(reuse[tuple(obj)].pop(0))
+        else:
+            last_ann_id += 1
+            entry['ann_ids'].append(last_ann_id)
+    return last_ann_id
+
+def scan_annotations(ann_dir, annotations, cached_files, workers = 1):
+    # reuse the cached record when size and mtime (or failing that, the content hash) are unchanged
+    files = {}
+    to_parse = []
+    for ann in annotations:
+        path = os.path.join(ann_dir, ann)
+        stat = os.stat(path)
+        entry = cached_files.get(ann)
 
-        # skip if image does not exist in the directory
-        if not file_name in images:
-            print(f'Skipping image "{file_name}" as it does not exist in img directory.')
-            no_image += 1
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            files[ann] = entry
             continue
 
-        curr_img_id += 1
+        digest = file_hash(path)
+        if entry is not None and entry['hash'] == digest:
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime_ns
+            files[ann] = entry
+            continue
 
-        # for images array
-        temp_images = {
-            'file_name': file_name,
-            'height': int(root.find('size').find('height').text),
-            'width': int(root.find('size').find('width').text),
-            'id': int(curr_img_id)
+        # new or edited file, keep the image id it had before (if any) and the ids of its objects, which go back to
+        # the same objects once it is parsed (see reuse_ann_ids)
+        files[ann] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': digest,
+            'record': None,
+            'image_id': entry['image_id'] if entry is not None else None,
+            'ann_ids': [],
+            'previous': previous_objects(entry)
         }
+        to_parse.append(ann)
+
+    records = parse_voc_files([os.path.join(ann_dir, ann) for ann in to_parse], workers)
+    for ann, record in zip(to_parse, records):
+        files[ann]['record'] = record
+
+    return files, len(to_parse)
+
+def voc2coco(ann_dir = os.getcwd(), img_dir = os.getcwd(), img_file_prefix = '', img_file_extension = '', output_filename = 'coco.json', categories = [], workers = 1, incremental = False, compact = False, columnar_dir = None,
+             verbose = True, metrics_path = None, profile_path = None):
+    # verbose = False drops the per-file messages, the counts are in the summary and in the metrics.
+    # metrics_path is a json-lines file the stage timings and counters of this run are appended to,
+    # profile_path runs the conversion under cProfile (see run_metrics)
+    with measured_run('voc2coco', metrics_path, profile_path, ann_dir = ann_dir, img_dir = img_dir,
+                      output_filename = output_filename, workers = workers, incremental = incremental) as metrics:
+        # List the xml label files
+        annotations = []
+        images = set()
+
+        bad_xml = 0
+        no_image = 0
+        no_error = 0
+
+        with stage(metrics, 'list_dir'):
+            ann_dir_files = os.listdir(ann_dir)
+            for file in ann_dir_files:
+                if file.endswith('.xml'):
+                    annotations.append(file)
+
+            img_dir_files = os.listdir(img_dir)
+            for file in img_dir_files:
+                if file.endswith(img_file_extension):
+                    images.add(file)
+
+        # Parse the xml files (in parallel when workers > 1), in incremental mode only the new/edited ones are parsed
+        with stage(metrics, 'parse'):
+            if incremental:
+                manifest = load_manifest(manifest_path(output_filename))
+                files, parsed = scan_annotations(ann_dir, annotations, manifest['files'], workers)
+            else:
+                manifest = {'last_img_id': 0, 'last_ann_id': 0, 'output_fingerprint': None, 'files': {}}
+                records = parse_voc_files([os.path.join(ann_dir, ann) for ann in annotations], workers)
+                files = {ann: {'hash': None, 'record': record, 'image_id': None, 'ann_ids': []} for ann, record in zip(annotations, records)}
+                parsed = len(annotations)
+        count(metrics, 'xml_files', len(annotations))
+        count(metrics, 'xml_parsed', parsed)
+
+        # Create the coco annotation
+        c_images = []
+        c_annotations = []
+        curr_img_id = manifest['last_img_id']
+        curr_ann_id = manifest['last_ann_id']
+        skipped_category = 0
+        # every option that changes what is written, so e.g. switching to compact rewrites an otherwise unchanged output
+        output_options = [compact, os.path.abspath(columnar_dir) if columnar_dir is not None else None]
+        fingerprint = hashlib.sha1(json.dumps([img_file_prefix, img_file_extension, categories, output_options]).encode())
+
+        with stage(metrics, 'index'):
+            for ann in annotations:
+                entry = files[ann]
+                record = entry['record']
+                fingerprint.update(f'{ann}:{entry["hash"]}'.encode())
 
-        c_images.append(temp_images)
+                # skip if annotation file is invalid
+                if record is None:
+                    if verbose:
+                        print(f'Annotation file "{ann}" invalid.')
+                    bad_xml += 1
+                    continue
+
+                file_name = img_file_prefix + record['filename'] + img_file_extension
+
+                # skip if image does not exist in the directory
+                if not file_name in images:
+                    if verbose:
+                        print(f'Skipping image "{file_name}" as it does not exist in img directory.')
+                    no_image += 1
+                    continue
+
+                fingerprint.update(b'+')
+
+                # ids are only handed out once per label file, new files continue from the last id ever used
+                if entry['image_id'] is None:
+                    curr_img_id += 1
+                    entry['image_id'] = curr_img_id
+                image_id = entry['image_id']
+
+                # for images array
+                temp_images = {
+                    'file_name': file_name,
+                    'height': record['height'],
+                    'width': record['width'],
+                    'id': int(image_id)
+                }
+
+                c_images.append(temp_images)
         
-        # for annotations array
-        for object in tree.findall('object'):
-            curr_ann_id += 1
-            obj_name = object.find('name').text
-            min_x = int(object.find('bndbox').find('xmin').text)
-            min_y = int(object.find('bndbox').find('ymin').text)
-            max_x = int(object.find('bndbox').find('xmax').text)
-            max_y = int(object.find('bndbox').find('ymax').text)
-
-            height = max_y - min_y
-            width = max_x - min_x
-
-            area = height * width
-            bbox = [min_x, min_y, width, height]
-
-            category_id = category_name_to_id(categories, obj_name)
-            if category_id == -1:
-                print(f'Skipping an annotation, not valid category "{obj_name}".')
-                continue
-
-            temp_annotation = {
-                'area': area,
-                'iscrowd': 0,
-                'bbox': bbox,
-                'category_id': category_id,
-                'ignore': 0,
-                'image_id': curr_img_id,
-                'id': curr_ann_id
-            }
-            c_annotations.append(temp_annotation)
+                # for annotations array
+                if len(entry['ann_ids']) != len(record['objects']):
+                    curr_ann_id = reuse_ann_ids(entry, record, curr_ann_id)
+                ann_ids = entry['ann_ids']
+                for index, (obj_name, min_x, min_y, max_x, max_y) in enumerate(record['objects']):
+                    height = max_y - min_y
+                    width = max_x - min_x
+
+                    area = height * width
+                    bbox = [min_x, min_y, width, height]
+
+                    category_id = category_name_to_id(categories, obj_name)
+                    if category_id == -1:
+                        if verbose:
+                            print(f'Skipping an annotation, not valid category "{obj_name}".')
+                        skipped_category += 1
+                        continue
+
+                    temp_annotation = {
+                        'area': area,
+                        'iscrowd': 0,
+                        'bbox': bbox,
+                        'category_id': category_id,
+                        'ignore': 0,
+                        'image_id': image_id,
+                        'id': ann_ids[index]
+                    }
+                    c_annotations.append(temp_annotation)
         
-        no_error += 1
+                no_error += 1
     
-    # create the coco json
-    coco = {
-        'images': c_images,
-        'annotations': c_annotations,
-        'categories': categories
-    }
+        count(metrics, 'bad_xml', bad_xml)
+        count(metrics, 'missing_image', no_image)
+        count(metrics, 'skipped_category', skipped_category)
+        count(metrics, 'images', len(c_images))
+        count(metrics, 'annotations', len(c_annotations))
 
-    # Serializing json
-    json_object = json.dumps(coco, indent=4)
-    
-    # Writing to sample.json
-    with open(output_filename, "w") as outfile:
-        outfile.write(json_object)
+        fingerprint = fingerprint.hexdigest()
+        up_to_date = incremental and fingerprint == manifest['output_fingerprint'] and os.path.exists(output_filename)
+
+        # create the coco json
+        coco = {
+            'images': c_images,
+            'annotations': c_annotations,
+            'categories': categories
+        }
+
+        if up_to_date:
+            print(f'Output "{output_filename}" is up to date, {parsed} files re-parsed.')
+        else:
+            # Streaming the json to a temp file and renaming it over the output
+            write_coco(output_filename, coco, compact, metrics)
+
+        # optional memory-mappable copy of the same annotations
+        if columnar_dir is not None and not (up_to_date and os.path.exists(os.path.join(columnar_dir, 'meta.json'))):
+            with stage(metrics, 'columnar'):
+                save_columnar(columnar_dir, coco)
+
+        if incremental:
+            manifest = {
+                'last_img_id': curr_img_id,
+                'last_ann_id': curr_ann_id,
+                'output_fingerprint': fingerprint,
+                'files': files
+            }
+            with stage(metrics, 'manifest'):
+                with open(manifest_path(output_filename), 'w') as file:
+                    json.dump(manifest, file)
     
-    print(f'Process completed with {bad_xml} bad xml files, {no_image} missing images, and {no_error} no errors. {bad_xml + no_image + no_error} files processed total.')
-
-voc2coco(ann_dir = '../heridal/trainImages/labels',
-         img_dir = '../heridal/trainImages',
-         img_file_prefix = 'train_',
-         img_file_extension = '.JPG',
-         output_filename = '../heridal/trainImages/coco_train_label.json',
-         categories = [{"supercategory": "none", "id": 0, "name": "human"}])
-
-voc2coco(ann_dir = '../heridal/testImages/labels',
-         img_dir = '../heridal/testImages',
-         img_file_prefix = 'test_',
-         img_file_extension = '.JPG',
-         output_filename = '../heridal/testImages/coco_test_label.json',
-         categories = [{"supercategory": "none", "id": 0, "name": "human"}])
+        print(f'Process completed with {bad_xml} bad xml files, {no_image} missing images, and {no_error} no errors. {bad_xml + no_image + no_error} files processed total.')
+        if skipped_category:
+            print(f'{skipped_category} annotations skipped for not having a valid category.')
+        return finish_metrics(metrics)
+
+# guarded so the worker processes (spawned on windows) can import this module without re-running the conversions
+if __name__ == '__main__':
+    voc2coco(ann_dir = '../heridal/trainImages/labels',
+             img_dir = '../heridal/trainImages',
+             img_file_prefix = 'train_',
+             img_file_extension = '.JPG',
+             output_filename = '../heridal/trainImages/coco_train_label.json',
+             categories = [{"supercategory": "none", "id": 0, "name": "human"}],
+             workers = os.cpu_count(),
+             incremental = True,
+             verbose = False,
+             metrics_path = 'metrics.jsonl')
+
+    voc2coco(ann_dir = '../heridal/testImages/labels',
+             img_dir = '../heridal/testImages',
+             img_file_prefix = 'test_',
+             img_file_extension = '.JPG',
+             output_filename = '../heridal/testImages/coco_test_label.json',
+             categories = [{"supercategory": "none", "id": 0, "name": "human"}],
+             workers = os.cpu_count(),
+             incremental = True,
+             verbose = False,
+             metrics_path = 'metrics.jsonl')
 
 """ Result from converting heridal xml annotations to coco
 Annotation file "train_BRA_1003.xml" invalid.